@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+
+import main
+
+CHARACTER_NAMES = [
+    "Leon Gabor", "Clyde Benson", "Joseph Cassel", "Milton Rokeach", "Ruth Cohen",
+    "Anna Kovacs", "Samuel Price", "Martha Hill", "Victor Lane", "Irene Moss"
+]
+
+class MockBackend:
+    """Deterministic stand-in for Ollama that answers each pipeline stage with
+    plausible JSON after a configurable delay.
+
+    Every response is derived from a hash of the prompt and the seed, so results do
+    not depend on thread scheduling. Latency is a fixed time-to-first-token plus one
+    token interval (1 / token_rate) per ~4 characters of output.
+    """
+
+    def __init__(self, latency=0.05, token_rate=200.0, malformed_rate=0.0, seed=0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.malformed_rate = malformed_rate
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.call_latencies = []
+        self.malformed = 0
+
+    def rng(self, prompt):
+        digest = hashlib.sha256(f"{self.seed}\0{prompt}".encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def respond(self, prompt):
+        rng = self.rng(prompt)
+        if "Reply only with OK" in prompt:
+            return "OK"
+
+        match = re.search(r"identify (\d+) key characters", prompt)
+        if match:
+            names = rng.sample(CHARACTER_NAMES, min(int(match.group(1)), len(CHARACTER_NAMES)))
+            payload = [{
+                "Name": name,
+                "Age": str(rng.randint(25, 70)),
+                "Description": "Gaunt face, tired eyes, short grey hair",
+                "Clothing": "Worn hospital robe over a pale shirt",
+                "Role": "Patient convinced of his own divinity"
+            } for name in names]
+        elif re.search(r"create (\d+) powerful visual scenes", prompt):
+            count = int(re.search(r"create (\d+) powerful visual scenes", prompt).group(1))
+            first = 1
+            # A follow-up for missing scenes lists the ones already provided; continue after them
+            match = re.search(r"These scenes were already provided: (\[.*?\])\.\nProvide ONLY the (\d+)", prompt)
+            if match:
+                first = len(json.loads(match.group(1))) + 1
+                count = int(match.group(2))
+            payload = [{
+                "Scene": f"Scene {idx}",
+                "Voiceover": f"Narrative line {idx} of the story, following {rng.choice(CHARACTER_NAMES).split()[0]}.",
+                "Description": "A dim ward, three men facing each other in silence, harsh window light."
+            } for idx in range(first, first + count)]
+        elif "JSON array with exactly" in prompt:
+            names = re.findall(r"^\d+\. Scene: (.*)$", prompt, re.M)
+            payload = [{
+                "Index": idx,
+                "Name": name,
+                "Positive prompt": f"{name}: men in a dim ward staring each other down. "
+                                   "Comic book-style illustration with a dark, gritty, realistic vibe.",
+                "Negative prompt": "text, blurry details"
+            } for idx, name in enumerate(names, 1)]
+        else:
+            match = re.search(r"^- Scene: (.*)$", prompt, re.M)
+            name = match.group(1) if match else "Scene"
+            payload = {
+                "Name": name,
+                "Positive prompt": f"{name}: men in a dim ward staring each other down. "
+                                   "Comic book-style illustration with a dark, gritty, realistic vibe.",
+                "Negative prompt": "text, blurry details"
+            }
+
+        text = f"Here is the result:\n```json\n{json.dumps(payload, indent=2)}\n```"
+        if rng.random() < self.malformed_rate:
+            with self.lock:
+                self.malformed += 1
+            text = self.corrupt(text, rng)
+        return text
+
+    def corrupt(self, text, rng):
+        choice = rng.randrange(3)
+        if choice == 0:
+            # Truncated generation
+            return text[:max(len(text) // 2, 1)]
+        if choice == 1:
+            # Trailing comma before the closing bracket or brace
+            return re.sub(r"\n([\]}])\n```$", r",\n\1\n```", text)
+        # Unescaped quote inside a string value
+        return text.replace('"Description": "', '"Description": "The "calm" ', 1)
+
+    def token_delay(self, text):
+        return (len(text) / 4) / self.token_rate if self.token_rate > 0 else 0.0
+
+    def generate(self, prompt):
+        start = time.perf_counter()
+        text = self.respond(prompt)
+        time.sleep(self.latency + self.token_delay(text))
+        with self.lock:
+            self.call_latencies.append(time.perf_counter() - start)
+        return text
+
+    def stream(self, prompt):
+        start = time.perf_counter()
+        text = self.respond(prompt)
+        time.sleep(self.latency)
+        try:
+            for pos in range(0, len(text), 16):
+                chunk = text[pos:pos + 16]
+                time.sleep(self.token_delay(chunk))
+                yield chunk
+        finally:
+            with self.lock:
+                self.call_latencies.append(time.perf_counter() - start)
+
+def time_parsers(parser_stats):
+    # Wraps the module-level parsers; the pipeline looks them up by name at call time
+    for name in ('parse_json_response_characters', 'parse_json_response_scenes', 'parse_json_response_scene_prompts'):
+        original = getattr(main, name)
+        parser_stats[name] = {'calls': 0, 'total_ms': 0.0}
+        lock = threading.Lock()
+
+        def timed(response, original=original, stats=parser_stats[name], lock=lock):
+            start = time.perf_counter()
+            try:
+                return original(response)
+            finally:
+                with lock:
+                    stats['calls'] += 1
+                    stats['total_ms'] += (time.perf_counter() - start) * 1000
+
+        setattr(main, name, timed)
+
+def prepare_inputs(source_dir, work_dir, num_stories):
+    sources = sorted(f for f in os.listdir(source_dir) if f.endswith('.txt'))
+    if not sources:
+        raise RuntimeError(f"No voiceover files found in {source_dir}")
+    input_dir = os.path.join(work_dir, 'input')
+    os.makedirs(input_dir)
+    stories = []
+    for idx in range(num_stories or len(sources)):
+        source = sources[idx % len(sources)]
+        story_file = f"{idx + 1:04d}_{source}"
+        shutil.copy(os.path.join(source_dir, source), os.path.join(input_dir, story_file))
+        if idx >= len(sources):
+            # Repeated copies get a distinct prompt, so mock responses (and the
+            # malformed ones among them) are not simply replayed per copy
+            with open(os.path.join(input_dir, story_file), 'a', encoding='utf-8') as f:
+                f.write(f"\n\n(Part {idx // len(sources) + 1})\n")
+        stories.append(story_file)
+    return input_dir, stories
+
+def run_benchmark(args):
+    backend = MockBackend(args.latency, args.token_rate, args.malformed_rate, args.seed)
+    main.register_backend('mock', backend.generate, backend.stream)
+    main.configure_ollama(backend='mock')
+    main.configure_cache(enabled=False)
+    main.set_max_inflight(args.max_inflight or max(args.jobs, args.concurrency), args.adaptive_concurrency)
+    if args.compact_characters or args.scene_token_budget:
+        main.configure_compaction(enabled=True, token_budget=args.scene_token_budget)
+
+    parser_stats = {}
+    time_parsers(parser_stats)
+
+    with tempfile.TemporaryDirectory(prefix='prompt_benchmark_') as work_dir:
+        input_dir, stories = prepare_inputs(args.input_dir, work_dir, args.stories)
+        output_dir = os.path.join(work_dir, 'output')
+        os.makedirs(output_dir)
+        start = time.perf_counter()
+        # run_batch prints a per-story table; keep stdout for the JSON report
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = main.run_batch(
+                stories, input_dir, output_dir, args.characters, args.scenes, args.jobs,
+                args.concurrency, stream=args.stream, batch_size=args.batch_size
+            )
+        wall_time = time.perf_counter() - start
+
+    latencies = backend.call_latencies
+    return {
+        'config': {
+            'stories': len(stories),
+            'characters': args.characters,
+            'scenes': args.scenes,
+            'jobs': args.jobs,
+            'concurrency': args.concurrency,
+            'batch_size': args.batch_size,
+            'stream': args.stream,
+            'adaptive_concurrency': args.adaptive_concurrency,
+            'compact_characters': args.compact_characters or bool(args.scene_token_budget),
+            'scene_token_budget': args.scene_token_budget,
+            'latency': args.latency,
+            'token_rate': args.token_rate,
+            'malformed_rate': args.malformed_rate,
+            'seed': args.seed
+        },
+        'wall_time': round(wall_time, 3),
+        'stories_per_min': round(len(stories) / wall_time * 60, 2) if wall_time else 0.0,
+        'failed_stories': report['failed'],
+        'partial_stories': sum(1 for result in report['results'] if result['status'] == 'partial'),
+        'llm_calls': len(latencies),
+        'llm_calls_per_story': round(len(latencies) / len(stories), 2),
+        'malformed_responses': backend.malformed,
+        'call_latency_ms': {
+            'p50': round(main.percentile(latencies, 0.50) * 1000, 2),
+            'p95': round(main.percentile(latencies, 0.95) * 1000, 2),
+            'max': round(max(latencies, default=0.0) * 1000, 2)
+        },
+        'character_sheet_tokens': report['compaction'],
+        'stages': main.summarize_metrics(),
+        'parser_ms': {
+            name: {
+                'calls': stats['calls'],
+                'total': round(stats['total_ms'], 3),
+                'mean': round(stats['total_ms'] / stats['calls'], 4) if stats['calls'] else 0.0
+            }
+            for name, stats in parser_stats.items()
+        }
+    }
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark the prompt generation pipeline against a mock LLM')
+    parser.add_argument('--input-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input'),
+                        help='Directory of voiceover .txt files to replay (default: ./input)')
+    parser.add_argument('--stories', type=int, default=10, help='Number of stories, cycling through the input files (default: 10)')
+    parser.add_argument('--characters', type=int, default=3, help='Characters per story (default: 3)')
+    parser.add_argument('--scenes', type=int, default=10, help='Scenes per story (default: 10)')
+    parser.add_argument('--jobs', type=int, default=1, help='Stories processed in parallel (default: 1)')
+    parser.add_argument('--concurrency', type=int, default=1, help='Scene prompts generated in parallel (default: 1)')
+    parser.add_argument('--max-inflight', type=int, help='Global cap on concurrent LLM calls')
+    parser.add_argument('--adaptive-concurrency', action='store_true', help='Let the in-flight cap follow latency')
+    parser.add_argument('--batch-size', type=int, default=1, help='Scenes per scene-prompt request (default: 1)')
+    parser.add_argument('--stream', action='store_true', help='Use the streaming pipeline')
+    parser.add_argument('--compact-characters', action='store_true', help='Send scene prompts only the characters they mention')
+    parser.add_argument('--scene-token-budget', type=int, help='Estimated token budget per scene prompt request')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mock time to first token in seconds (default: 0.05)')
+    parser.add_argument('--token-rate', type=float, default=200.0, help='Mock tokens per second, 0 for instant (default: 200)')
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help='Fraction of responses with broken JSON (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the mock responses (default: 0)')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    main.setup_logging()
+    results = run_benchmark(args)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + "\n")
+        print(f"Benchmark results saved to {args.output}")
+    else:
+        print(report)
+    sys.exit(1 if results['failed_stories'] == results['config']['stories'] else 0)
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,29 +1,103 @@
 #!/usr/bin/env python3
 
+import time
+
+# Started before the other imports so --profile-startup covers them too
+_module_load_start = time.perf_counter()
+
 import os
 import sys
+import re
 import json
-import time
 import subprocess
+import atexit
 import argparse
 import logging
-from tqdm import tqdm
-from pynput import keyboard
+import hashlib
+import random
+import sqlite3
+import threading
+import codecs
+import importlib
+import contextvars
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+_stdlib_imported = time.perf_counter()
+
+# Third-party modules are imported on first use (see lazy_import), so runs that never
+# touch HTTP, progress bars or the keyboard do not pay for them at startup
+requests = None
+_import_times = {}
+_import_lock = threading.Lock()
+
+def lazy_import(name):
+    # Serialized so a worker thread never sees another thread's half-imported module
+    with _import_lock:
+        if name in sys.modules:
+            return importlib.import_module(name)
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        _import_times[name] = time.perf_counter() - start
+        return module
+
+def get_requests():
+    global requests
+    if requests is None:
+        requests = lazy_import('requests')
+    return requests
+
+class NullProgress:
+    # Stand-in for a disabled tqdm bar
+    def __init__(self, iterable=None):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def update(self, n=1):
+        pass
 
-# Set up logging
-logging.basicConfig(
-    filename='script.log',
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s:%(message)s'
-)
+def progress_bar(iterable=None, disable=False, **kwargs):
+    if disable:
+        return NullProgress(iterable)
+    return lazy_import('tqdm').tqdm(iterable, **kwargs)
 
-paused = False
+def setup_logging(log_file='script.log'):
+    logging.basicConfig(
+        filename=log_file,
+        level=logging.DEBUG,
+        format='%(asctime)s %(levelname)s:%(message)s'
+    )
+
+def print_startup_profile(timings):
+    print("\nStartup profile (ms):", file=sys.stderr)
+    for label, seconds in timings.items():
+        print(f"  {label:<26} {seconds * 1000:8.1f}", file=sys.stderr)
+    for name, seconds in sorted(_import_times.items()):
+        print(f"  {'import ' + name:<26} {seconds * 1000:8.1f}  (on first use)", file=sys.stderr)
+
+# Set while processing may continue; cleared while paused with F6
+resume_event = threading.Event()
+resume_event.set()
+
+# pynput needs a display and is only imported by the interactive paths
+keyboard = None
 
 def on_press(key):
-    global paused
     try:
         if key == keyboard.Key.f6:
-            paused = not paused
+            paused = resume_event.is_set()
+            if paused:
+                resume_event.clear()
+            else:
+                resume_event.set()
             state = "Paused" if paused else "Resumed"
             print(f"\n{state}... (Press F6 to {('resume' if paused else 'pause')})")
             logging.info(f"Process {state.lower()} by user.")
@@ -31,6 +105,8 @@ def on_press(key):
         pass
 
 def start_keyboard_listener():
+    global keyboard
+    keyboard = lazy_import('pynput.keyboard')
     print("\nPress F6 at any time to pause/resume processing")
     listener = keyboard.Listener(on_press=on_press)
     listener.start()
@@ -56,118 +132,1125 @@ def load_voiceover(file_path):
         logging.error(f"Error reading voiceover file {file_path}: {e}")
         return ""
 
-def run_ollama(prompt):
+# Run metrics: every LLM call, parse failure and pipeline stage is recorded as an
+# event, kept in memory for the end-of-run summary and optionally traced as JSONL
+metrics_settings = {
+    'trace_file': None,
+    'prometheus_file': None,
+    # Full prompts and responses are only formatted and logged when asked for
+    'log_payloads': False,
+}
+
+metrics_events = []
+_metrics_lock = threading.Lock()
+_trace_handle = None
+
+# Story being processed by the current thread; copied into scene-prompt workers
+current_story = contextvars.ContextVar('current_story', default=None)
+
+def configure_metrics(trace_file=None, prometheus_file=None, log_payloads=None):
+    close_trace()
+    if trace_file is not None:
+        metrics_settings['trace_file'] = trace_file
+    if prometheus_file is not None:
+        metrics_settings['prometheus_file'] = prometheus_file
+    if log_payloads is not None:
+        metrics_settings['log_payloads'] = log_payloads
+
+def log_payload(label, *parts):
+    if metrics_settings['log_payloads']:
+        logging.debug(f"{label}:\n{''.join(str(part) for part in parts)}")
+
+def record_event(event):
+    global _trace_handle
+    event.setdefault('time', round(time.time(), 3))
+    with _metrics_lock:
+        metrics_events.append(event)
+        if metrics_settings['trace_file']:
+            try:
+                if _trace_handle is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(metrics_settings['trace_file'])), exist_ok=True)
+                    _trace_handle = open(metrics_settings['trace_file'], 'w', encoding="utf-8", buffering=1 << 16)
+                _trace_handle.write(json.dumps(event) + "\n")
+            except Exception as e:
+                logging.error(f"Error writing trace {metrics_settings['trace_file']}: {e}")
+                metrics_settings['trace_file'] = None
+
+def close_trace():
+    global _trace_handle
+    with _metrics_lock:
+        if _trace_handle is not None:
+            _trace_handle.close()
+            _trace_handle = None
+
+def start_llm_call(stage):
+    return {
+        'type': 'llm_call',
+        'story': current_story.get(),
+        'stage': stage,
+        'backend': ollama_settings['backend'],
+        'model': model_for(stage),
+        'endpoint': None,
+        'time': round(time.time(), 3),
+        'started': time.perf_counter(),
+        'deadline': None,
+        'deadline_exceeded': False,
+        'wait_time': 0.0,
+        'cache_hit': False,
+        'retries': 0,
+        'fallback': False,
+        'prompt_tokens': None,
+        'prompt_eval_tokens': None,
+        'completion_tokens': None,
+    }
+
+def finish_llm_call(call, response):
+    call.pop('deadline')
+    call['wall_time'] = round(time.perf_counter() - call.pop('started'), 4)
+    call['wait_time'] = round(call['wait_time'], 4)
+    # A stream that broke off after some output has a response but did not succeed
+    call['ok'] = bool(response) and not call.pop('stream_failed', False)
+    call['response_chars'] = len(response or '')
+    record_event(call)
+
+def record_parse_failure(stage):
+    record_event({'type': 'parse_failure', 'story': current_story.get(), 'stage': stage})
+
+def record_story(summary):
+    for stage, seconds in summary['timings'].items():
+        if stage != 'total':
+            record_event({'type': 'stage', 'story': summary['story'], 'stage': stage, 'wall_time': seconds})
+    record_event(dict(summary, type='story'))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = fraction * (len(ordered) - 1)
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize_metrics():
+    with _metrics_lock:
+        events = list(metrics_events)
+    stages = {}
+    for event in events:
+        if event['type'] not in ('llm_call', 'parse_failure'):
+            continue
+        stats = stages.setdefault(event['stage'] or 'other', {
+            'calls': 0, 'cache_hits': 0, 'retries': 0, 'failed': 0, 'parse_failures': 0,
+            'prompt_tokens': 0, 'completion_tokens': 0, 'latencies': []
+        })
+        if event['type'] == 'parse_failure':
+            stats['parse_failures'] += 1
+            continue
+        stats['calls'] += 1
+        stats['cache_hits'] += event['cache_hit']
+        stats['retries'] += event['retries']
+        stats['failed'] += not event['ok']
+        stats['prompt_tokens'] += event['prompt_tokens'] or 0
+        stats['completion_tokens'] += event['completion_tokens'] or 0
+        if not event['cache_hit']:
+            stats['latencies'].append(event['wall_time'])
+    for stats in stages.values():
+        latencies = stats.pop('latencies')
+        stats['latency_p50'] = round(percentile(latencies, 0.50), 3)
+        stats['latency_p95'] = round(percentile(latencies, 0.95), 3)
+        stats['latency_sum'] = round(sum(latencies), 3)
+    return stages
+
+def print_metrics_summary(stages):
+    if not stages:
+        return
+    print(f"\n{'Stage':<14} {'Calls':>6} {'Cached':>6} {'Retries':>7} {'Failed':>6} {'Parse':>6} "
+          f"{'p50 (s)':>8} {'p95 (s)':>8} {'Prompt tok':>10} {'Compl tok':>9}")
+    for stage, stats in sorted(stages.items()):
+        print(f"{stage:<14} {stats['calls']:>6} {stats['cache_hits']:>6} {stats['retries']:>7} {stats['failed']:>6} "
+              f"{stats['parse_failures']:>6} {stats['latency_p50']:>8.2f} {stats['latency_p95']:>8.2f} "
+              f"{stats['prompt_tokens']:>10} {stats['completion_tokens']:>9}")
+
+def write_prometheus(file_path, stages, stories=None):
+    # Prometheus node_exporter textfile format; written to a temp file and renamed so the
+    # collector never reads a half-written file
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP prompt_generator_{name} {help_text}")
+        lines.append(f"# TYPE prompt_generator_{name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{val}"' for key, val in labels.items())
+            lines.append(f"prompt_generator_{name}{{{label_text}}} {value}")
+
+    metric('llm_calls_total', 'counter', 'LLM calls by pipeline stage',
+           [({'stage': stage}, stats['calls']) for stage, stats in stages.items()])
+    metric('llm_cache_hits_total', 'counter', 'LLM calls answered from the response cache',
+           [({'stage': stage}, stats['cache_hits']) for stage, stats in stages.items()])
+    metric('llm_retries_total', 'counter', 'HTTP retries of LLM calls',
+           [({'stage': stage}, stats['retries']) for stage, stats in stages.items()])
+    metric('llm_failures_total', 'counter', 'LLM calls that returned no response',
+           [({'stage': stage}, stats['failed']) for stage, stats in stages.items()])
+    metric('parse_failures_total', 'counter', 'LLM responses that could not be parsed',
+           [({'stage': stage}, stats['parse_failures']) for stage, stats in stages.items()])
+    metric('llm_call_seconds_sum', 'counter', 'Total wall time of uncached LLM calls',
+           [({'stage': stage}, stats['latency_sum']) for stage, stats in stages.items()])
+    metric('llm_call_seconds', 'gauge', 'LLM call latency quantiles',
+           [({'stage': stage, 'quantile': '0.5'}, stats['latency_p50']) for stage, stats in stages.items()] +
+           [({'stage': stage, 'quantile': '0.95'}, stats['latency_p95']) for stage, stats in stages.items()])
+    metric('prompt_tokens_total', 'counter', 'Prompt tokens sent to the model',
+           [({'stage': stage}, stats['prompt_tokens']) for stage, stats in stages.items()])
+    metric('completion_tokens_total', 'counter', 'Tokens generated by the model',
+           [({'stage': stage}, stats['completion_tokens']) for stage, stats in stages.items()])
+    if stories:
+        statuses = {}
+        for story in stories:
+            statuses[story['status']] = statuses.get(story['status'], 0) + 1
+        metric('stories_total', 'counter', 'Stories processed by final status',
+               [({'status': status}, count) for status, count in sorted(statuses.items())])
+
     try:
-        command = ["ollama", "run", "mistral-nemo"]
-        result = subprocess.run(
-            command,
-            input=prompt,
-            capture_output=True,
-            text=True,
-            encoding='utf-8'
+        write_atomic(file_path, ["\n".join(lines) + "\n"])
+        logging.info(f"Prometheus metrics saved to {file_path}")
+    except Exception as e:
+        logging.error(f"Error saving Prometheus metrics to {file_path}: {e}")
+
+# Ollama backend settings, overridden from the command line in main()
+ollama_settings = {
+    'backend': 'http',
+    'host': os.environ.get('OLLAMA_HOST', 'http://localhost:11434'),
+    'model': 'mistral-nemo',
+    'keep_alive': '30m',
+    'connect_timeout': 5.0,
+    'timeout': 600.0,
+    'retries': 2,
+    # Retries wait a random time up to retry_backoff * 2^attempt, capped at retry_backoff_max
+    'retry_backoff': 1.0,
+    'retry_backoff_max': 30.0,
+    # Overall deadline in seconds per stage call, covering every retry and the CLI fallback
+    'stage_timeouts': {},
+    'cli_fallback': True,
+    # Evaluate shared prompt prefixes once per story and continue from Ollama's context
+    'reuse_context': False,
+    # Send each stage's JSON schema as Ollama's structured-output format
+    'structured_output': True,
+    # Generation options forwarded to Ollama (temperature, num_ctx, ...); part of the cache key
+    'options': {},
+    # Extra Ollama servers to balance over ("URL" or "URL=model1,model2" to limit the
+    # models an endpoint serves); empty means just host
+    'endpoints': [],
+    # Consecutive failures before an endpoint leaves the rotation, and for how long
+    'endpoint_max_failures': 3,
+    'endpoint_cooldown': 30.0,
+    # Per-stage model overrides, e.g. a smaller model for scene_prompts
+    'stage_models': {},
+}
+
+STAGES = ('characters', 'scenes', 'scene_prompts')
+
+_http_session = None
+
+# Additional in-process backends (e.g. the benchmark's mock LLM), selected by name
+# through ollama_settings['backend']
+custom_backends = {}
+
+def register_backend(name, generate, stream=None):
+    # generate(prompt) returns the full completion; stream(prompt) yields text chunks
+    custom_backends[name] = {'generate': generate, 'stream': stream}
+
+# Caps LLM calls in flight across every story and worker thread; None means unlimited
+llm_slots = None
+
+class AdaptiveLimiter:
+    """Drop-in replacement for the llm_slots semaphore whose limit follows latency.
+
+    Latency is smoothed per stage and compared with the best smoothed latency seen for
+    that stage. When it climbs past tolerance times that baseline, or a call fails, the
+    limit is cut by a third (at most once per call duration); after a limit's worth of
+    healthy calls it grows by one again, up to max_limit. The baseline creeps up slowly
+    so a permanently slower setup is eventually accepted as normal.
+    """
+
+    def __init__(self, max_limit, min_limit=1, tolerance=2.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.tolerance = tolerance
+        self.limit = max_limit
+        self.inflight = 0
+        self.healthy_calls = 0
+        self.last_decrease = 0.0
+        self.smoothed = {}
+        self.baseline = {}
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.inflight >= self.limit:
+                self.condition.wait()
+            self.inflight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify()
+        return False
+
+    def record(self, stage, latency, ok):
+        with self.condition:
+            smoothed = latency if stage not in self.smoothed else 0.8 * self.smoothed[stage] + 0.2 * latency
+            self.smoothed[stage] = smoothed
+            baseline = min(self.baseline.get(stage, smoothed) * 1.01, smoothed)
+            self.baseline[stage] = baseline
+            now = time.monotonic()
+            if not ok or smoothed > baseline * self.tolerance:
+                self.healthy_calls = 0
+                if self.limit > self.min_limit and now - self.last_decrease > latency:
+                    self.limit = max(self.min_limit, int(self.limit * 2 / 3))
+                    self.last_decrease = now
+                    logging.info(f"LLM latency for {stage} at {smoothed:.1f}s vs {baseline:.1f}s baseline, "
+                                 f"concurrency limit lowered to {self.limit}")
+                return
+            self.healthy_calls += 1
+            if self.healthy_calls >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.healthy_calls = 0
+                self.condition.notify_all()
+
+def set_max_inflight(limit, adaptive=False):
+    global llm_slots
+    if not limit or limit <= 0:
+        llm_slots = None
+    elif adaptive:
+        llm_slots = AdaptiveLimiter(limit)
+    else:
+        llm_slots = threading.BoundedSemaphore(limit)
+
+def record_call_latency(stage, latency, ok):
+    if isinstance(llm_slots, AdaptiveLimiter):
+        llm_slots.record(stage, latency, ok)
+
+def normalize_host(host):
+    if not host.startswith(('http://', 'https://')):
+        host = f"http://{host}"
+    return host.rstrip('/')
+
+def configure_ollama(**overrides):
+    global _http_session, _endpoint_pool
+    for key, value in overrides.items():
+        if value is not None:
+            ollama_settings[key] = value
+    ollama_settings['host'] = normalize_host(ollama_settings['host'])
+    if _http_session is not None:
+        _http_session.close()
+        _http_session = None
+    with _endpoint_lock:
+        _endpoint_pool = None
+
+def model_for(stage):
+    return ollama_settings['stage_models'].get(stage) or ollama_settings['model']
+
+def stage_deadline(stage):
+    timeout = ollama_settings['stage_timeouts'].get(stage)
+    return time.perf_counter() + timeout if timeout else None
+
+def time_left(call):
+    # Seconds until the call's stage deadline, or None when it has none
+    if call is None or call.get('deadline') is None:
+        return None
+    remaining = call['deadline'] - time.perf_counter()
+    if remaining <= 0:
+        call['deadline_exceeded'] = True
+    return remaining
+
+def request_timeout(call):
+    remaining = time_left(call)
+    read_timeout = ollama_settings['timeout'] if remaining is None else min(ollama_settings['timeout'], remaining)
+    return (ollama_settings['connect_timeout'], read_timeout)
+
+def retry_delay(attempt, call=None):
+    # Full jitter spreads out the retries of many workers that failed together
+    delay = random.uniform(0, min(ollama_settings['retry_backoff_max'], ollama_settings['retry_backoff'] * 2 ** (attempt - 1)))
+    remaining = time_left(call)
+    return delay if remaining is None else max(min(delay, remaining), 0)
+
+# Endpoint pool: every HTTP request goes to the least-loaded healthy endpoint that serves
+# its model. Each endpoint is a circuit breaker: after endpoint_max_failures consecutive
+# failures it opens for endpoint_cooldown seconds, during which requests fail fast instead
+# of waiting on a dead server, then lets a single probe request through (half-open).
+_endpoint_pool = None
+_endpoint_lock = threading.Lock()
+
+def parse_endpoint(spec):
+    host, _, models = spec.partition('=')
+    return {
+        'host': normalize_host(host.strip()),
+        'models': {model.strip() for model in models.split(',') if model.strip()} or None,
+        'inflight': 0,
+        'calls': 0,
+        'errors': 0,
+        'failures': 0,
+        'down_until': 0.0
+    }
+
+def get_endpoint_pool():
+    # Called with _endpoint_lock held
+    global _endpoint_pool
+    if _endpoint_pool is None:
+        _endpoint_pool = [parse_endpoint(spec) for spec in ollama_settings['endpoints'] or [ollama_settings['host']]]
+    return _endpoint_pool
+
+def acquire_endpoint(model):
+    with _endpoint_lock:
+        candidates = [endpoint for endpoint in get_endpoint_pool()
+                      if endpoint['models'] is None or model in endpoint['models']]
+        if not candidates:
+            logging.error(f"No Ollama endpoint serves model {model}")
+            return None
+        now = time.monotonic()
+        healthy = [
+            endpoint for endpoint in candidates
+            if endpoint['down_until'] <= now
+            and (endpoint['failures'] < ollama_settings['endpoint_max_failures'] or endpoint['inflight'] == 0)
+        ]
+        if not healthy:
+            logging.warning(f"Every endpoint serving {model} is out of rotation, failing fast")
+            return None
+        endpoint = min(healthy, key=lambda endpoint: (endpoint['inflight'], endpoint['calls']))
+        endpoint['inflight'] += 1
+        endpoint['calls'] += 1
+        return endpoint
+
+def release_endpoint(endpoint, ok):
+    with _endpoint_lock:
+        endpoint['inflight'] -= 1
+        if ok:
+            endpoint['failures'] = 0
+            endpoint['down_until'] = 0.0
+            return
+        endpoint['errors'] += 1
+        endpoint['failures'] += 1
+        if endpoint['failures'] >= ollama_settings['endpoint_max_failures']:
+            endpoint['down_until'] = time.monotonic() + ollama_settings['endpoint_cooldown']
+            logging.warning(f"Ollama endpoint {endpoint['host']} failed {endpoint['failures']} times in a row, "
+                            f"taking it out of rotation for {ollama_settings['endpoint_cooldown']:.0f}s")
+
+def endpoint_stats():
+    with _endpoint_lock:
+        now = time.monotonic()
+        return [{
+            'host': endpoint['host'],
+            'models': sorted(endpoint['models']) if endpoint['models'] else None,
+            'calls': endpoint['calls'],
+            'errors': endpoint['errors'],
+            'healthy': endpoint['down_until'] <= now
+        } for endpoint in get_endpoint_pool()]
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        session = get_requests().Session()
+        # Keep-alive connections are pooled per host and reused across calls
+        adapter = lazy_import('requests.adapters').HTTPAdapter(
+            pool_connections=max(4, len(ollama_settings['endpoints'])), pool_maxsize=16
         )
-        if result.returncode != 0:
-            logging.error(f"Ollama error: {result.stderr}")
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_session = session
+    return _http_session
+
+def build_generate_payload(prompt, stream=False, context=None, fmt=None, model=None):
+    payload = {
+        'model': model or ollama_settings['model'],
+        'prompt': prompt,
+        'stream': stream,
+        'keep_alive': ollama_settings['keep_alive'],
+    }
+    if ollama_settings['options']:
+        payload['options'] = ollama_settings['options']
+    if context:
+        payload['context'] = context
+    if fmt and ollama_settings['structured_output']:
+        payload['format'] = fmt
+    return payload
+
+def post_generate(payload, call=None):
+    # Each attempt picks an endpoint afresh, so a retry lands on another server when one is busy or down
+    attempts = ollama_settings['retries'] + 1
+    for attempt in range(1, attempts + 1):
+        remaining = time_left(call)
+        if remaining is not None and remaining <= 0:
+            logging.warning(f"Stage deadline exceeded after {attempt - 1} attempt(s), giving up")
+            return None
+        endpoint = acquire_endpoint(payload['model'])
+        if endpoint is None:
+            return None
+        if call is not None:
+            call['endpoint'] = endpoint['host']
+        ok = False
+        try:
+            response = get_http_session().post(f"{endpoint['host']}/api/generate", json=payload,
+                                               timeout=request_timeout(call))
+            response.raise_for_status()
+            data = response.json()
+            ok = True
+            return data
+        except (get_requests().RequestException, ValueError) as e:
+            logging.warning(f"Ollama HTTP request to {endpoint['host']} failed (attempt {attempt}/{attempts}): {e}")
+        finally:
+            release_endpoint(endpoint, ok)
+        remaining = time_left(call)
+        if attempt < attempts and (remaining is None or remaining > 0):
+            if call is not None:
+                call['retries'] += 1
+            time.sleep(retry_delay(attempt, call))
+    return None
+
+# Prompt tokens sent vs. actually evaluated, from Ollama's generate stats
+token_stats = {'prompt_tokens': 0, 'prompt_eval_tokens': 0, 'prompt_eval_saved': 0}
+_token_stats_lock = threading.Lock()
+
+def record_prompt_eval(data, call=None):
+    # The returned context holds every input token plus the generated ones, so the
+    # difference to prompt_eval_count is what Ollama served from its KV cache.
+    context = data.get('context')
+    if call is not None:
+        call['prompt_eval_tokens'] = data.get('prompt_eval_count')
+        call['completion_tokens'] = data.get('eval_count')
+        call['prompt_tokens'] = len(context) - data.get('eval_count', 0) if context else data.get('prompt_eval_count')
+    if not context or 'prompt_eval_count' not in data:
+        return
+    prompt_tokens = len(context) - data.get('eval_count', 0)
+    evaluated = data['prompt_eval_count']
+    with _token_stats_lock:
+        token_stats['prompt_tokens'] += prompt_tokens
+        token_stats['prompt_eval_tokens'] += evaluated
+        token_stats['prompt_eval_saved'] += max(prompt_tokens - evaluated, 0)
+
+def run_ollama_http(prompt, context=None, call=None, fmt=None, model=None):
+    data = post_generate(build_generate_payload(prompt, context=context, fmt=fmt, model=model), call)
+    if data is None:
+        return None
+    record_prompt_eval(data, call)
+    text = data.get('response', '').strip()
+    log_payload("LLM Response", text)
+    return text
+
+# Ollama contexts for shared prompt prefixes (story text, character sheet), keyed by hash
+_prefix_contexts = {}
+_prefix_locks = {}
+_prefix_contexts_lock = threading.Lock()
+
+def get_prefix_context(prefix, model=None):
+    # Evaluates a shared prefix once and returns the context tokens that later calls
+    # continue from, so Ollama can serve the prefix from its KV cache. Context tokens
+    # are only meaningful to the model that produced them.
+    model = model or ollama_settings['model']
+    key = hashlib.sha256(f"{model}\0{prefix}".encode('utf-8')).hexdigest()
+    with _prefix_contexts_lock:
+        if key in _prefix_contexts:
+            return _prefix_contexts[key]
+        key_lock = _prefix_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        if key not in _prefix_contexts:
+            payload = build_generate_payload(prefix + "\nRead the material above; the next messages will ask about it. Reply only with OK.", model=model)
+            payload['options'] = dict(payload.get('options', {}), num_predict=2)
+            call = start_llm_call('prefix')
+            call['model'] = model
+            data = post_generate(payload, call)
+            context = data.get('context') if data else None
+            if data:
+                record_prompt_eval(data, call)
+            finish_llm_call(call, data.get('response') if data else None)
+            if not context:
+                logging.warning("Ollama returned no context for the shared prompt prefix, sending full prompts")
+            with _prefix_contexts_lock:
+                _prefix_contexts[key] = context
+        return _prefix_contexts[key]
+
+def run_ollama_cli(prompt, model=None, call=None):
+    command = ["ollama", "run", model or ollama_settings['model']]
+    attempts = ollama_settings['retries'] + 1
+    for attempt in range(1, attempts + 1):
+        remaining = time_left(call)
+        if remaining is not None and remaining <= 0:
+            logging.error("Stage deadline exceeded before 'ollama run' could finish")
             return ""
-        logging.debug(f"LLM Response:\n{result.stdout.strip()}")
-        return result.stdout.strip()
-    except Exception as e:
-        logging.error(f"Error running Ollama: {e}")
-        return ""
+        try:
+            result = subprocess.run(
+                command,
+                input=prompt,
+                capture_output=True,
+                text=True,
+                encoding='utf-8',
+                timeout=request_timeout(call)[1]
+            )
+            if result.returncode == 0 and result.stdout.strip():
+                log_payload("LLM Response", result.stdout.strip())
+                return result.stdout.strip()
+            logging.error(f"Ollama error (attempt {attempt}/{attempts}, exit {result.returncode}): {result.stderr}")
+        except Exception as e:
+            logging.error(f"Error running Ollama (attempt {attempt}/{attempts}): {e}")
+        remaining = time_left(call)
+        if attempt < attempts and (remaining is None or remaining > 0):
+            if call is not None:
+                call['retries'] += 1
+            time.sleep(retry_delay(attempt, call))
+    return ""
 
-def parse_json_response_characters(response):
+def dispatch_ollama(prompt, prefix='', call=None, fmt=None, model=None):
+    if ollama_settings['backend'] in custom_backends:
+        return custom_backends[ollama_settings['backend']]['generate'](prefix + prompt)
+    if ollama_settings['backend'] == 'http':
+        context = get_prefix_context(prefix, model) if prefix and ollama_settings['reuse_context'] else None
+        if context:
+            response = run_ollama_http(prompt, context, call, fmt, model)
+        else:
+            response = run_ollama_http(prefix + prompt, call=call, fmt=fmt, model=model)
+        if response is not None:
+            return response
+        if not ollama_settings['cli_fallback']:
+            logging.error("Ollama HTTP backend failed and CLI fallback is disabled")
+            return ""
+        logging.warning("Ollama HTTP backend unavailable, falling back to 'ollama run'")
+        if call is not None:
+            call['fallback'] = True
+    return run_ollama_cli(prefix + prompt, model, call)
+
+# On-disk response cache keyed by a hash of (model, prompt, generation options)
+cache_settings = {
+    'enabled': True,
+    'dir': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'),
+    'max_bytes': 256 * 1024 * 1024,
+}
+
+_cache_conn = None
+_cache_size = 0
+_cache_lock = threading.Lock()
+
+def configure_cache(enabled=None, cache_dir=None, max_bytes=None):
+    global _cache_conn
+    if enabled is not None:
+        cache_settings['enabled'] = enabled
+    if cache_dir is not None:
+        cache_settings['dir'] = cache_dir
+    if max_bytes is not None:
+        cache_settings['max_bytes'] = max_bytes
+    with _cache_lock:
+        if _cache_conn is not None:
+            _cache_conn.close()
+            _cache_conn = None
+
+def get_cache_connection():
+    global _cache_conn, _cache_size
+    if _cache_conn is None:
+        os.makedirs(cache_settings['dir'], exist_ok=True)
+        conn = sqlite3.connect(os.path.join(cache_settings['dir'], 'responses.sqlite3'), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        _cache_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        _cache_conn = conn
+    return _cache_conn
+
+def response_cache_key(prompt, stage=None):
+    material = json.dumps({
+        'model': model_for(stage),
+        'prompt': prompt,
+        'options': ollama_settings['options'],
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def get_cached_response(prompt, stage=None):
+    if not cache_settings['enabled']:
+        return None
+    key = response_cache_key(prompt, stage)
     try:
-        start = response.find('[')
-        end = response.rfind(']') + 1
-        
-        if start == -1 or end == 0:
-            logging.error("No JSON array found in character response")
-            return []
-            
-        json_str = response[start:end]
-        json_str = json_str.strip().rstrip('\\')
-        parsed = json.loads(json_str)
-        
-        if not isinstance(parsed, list):
-            logging.error("Parsed character JSON is not an array")
+        with _cache_lock:
+            conn = get_cache_connection()
+            row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        logging.debug(f"Cache hit for prompt {key[:12]}")
+        return row[0]
+    except sqlite3.Error as e:
+        logging.error(f"Error reading response cache: {e}")
+        return None
+
+def store_cached_response(prompt, response, stage=None):
+    global _cache_size
+    if not cache_settings['enabled'] or not response:
+        return
+    key = response_cache_key(prompt, stage)
+    size = len(response.encode('utf-8'))
+    try:
+        with _cache_lock:
+            conn = get_cache_connection()
+            row = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            _cache_size += size - (row[0] if row else 0)
+            # Evict least recently used entries until the cache fits its size budget
+            while _cache_size > cache_settings['max_bytes']:
+                oldest = conn.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 1").fetchone()
+                if oldest is None or oldest[0] == key:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+                _cache_size -= oldest[1]
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Error writing response cache: {e}")
+
+def invalidate_cached_response(prompt, stage=None):
+    global _cache_size
+    if not cache_settings['enabled']:
+        return
+    key = response_cache_key(prompt, stage)
+    try:
+        with _cache_lock:
+            conn = get_cache_connection()
+            row = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+                _cache_size -= row[0]
+    except sqlite3.Error as e:
+        logging.error(f"Error invalidating response cache: {e}")
+
+def run_ollama(prompt, prefix='', stage=None, fmt=None):
+    # prefix is the shared leading part of the prompt (story text, character sheet);
+    # the cache always sees the full prompt regardless of how it is sent. fmt is the
+    # JSON schema the HTTP backend asks Ollama to constrain the output to.
+    call = start_llm_call(stage)
+    cached = get_cached_response(prefix + prompt, stage)
+    if cached is not None:
+        call['cache_hit'] = True
+        finish_llm_call(call, cached)
+        return cached
+    wait_start = time.perf_counter()
+    with llm_slots or nullcontext():
+        call['wait_time'] = time.perf_counter() - wait_start
+        # The stage deadline starts once the call holds a slot, so queueing does not eat into it
+        call['deadline'] = stage_deadline(stage)
+        call_start = time.perf_counter()
+        response = dispatch_ollama(prompt, prefix, call, fmt, model_for(stage))
+    record_call_latency(stage, time.perf_counter() - call_start, bool(response))
+    store_cached_response(prefix + prompt, response, stage)
+    finish_llm_call(call, response)
+    return response
+
+def stream_ollama_http(prompt, context=None, call=None, fmt=None, model=None):
+    payload = build_generate_payload(prompt, stream=True, context=context, fmt=fmt, model=model)
+    timeout = request_timeout(call)
+    endpoint = acquire_endpoint(payload['model'])
+    if endpoint is None:
+        raise RuntimeError(f"No Ollama endpoint serves model {payload['model']}")
+    if call is not None:
+        call['endpoint'] = endpoint['host']
+    ok = False
+    response = None
+    try:
+        response = get_http_session().post(f"{endpoint['host']}/api/generate", json=payload, timeout=timeout, stream=True)
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get('error'):
+                raise RuntimeError(f"Ollama stream error: {chunk['error']}")
+            remaining = time_left(call)
+            if remaining is not None and remaining <= 0:
+                raise RuntimeError("Stage deadline exceeded while streaming")
+            # Any streamed output means the endpoint itself is working, even if we stop early
+            ok = True
+            yield chunk.get('response', '')
+            if chunk.get('done'):
+                record_prompt_eval(chunk, call)
+                break
+        ok = True
+    finally:
+        # Closing the response mid-stream makes Ollama stop generating
+        if response is not None:
+            response.close()
+        release_endpoint(endpoint, ok)
+
+def stream_ollama_cli(prompt, model=None, call=None):
+    process = subprocess.Popen(
+        ["ollama", "run", model or ollama_settings['model']],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    # read1 blocks on a hung model, so a timer enforces the timeout or stage deadline
+    watchdog = threading.Timer(max(request_timeout(call)[1], 0), process.kill)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        process.stdin.write(prompt.encode('utf-8'))
+        process.stdin.close()
+        while True:
+            data = process.stdout.read1(4096)
+            if not data:
+                break
+            yield decoder.decode(data)
+        yield decoder.decode(b'', final=True)
+        if process.wait() != 0:
+            logging.error(f"Ollama exited with code {process.returncode}")
+            if call is not None:
+                call['stream_failed'] = True
+    finally:
+        watchdog.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+def dispatch_ollama_stream(prompt, prefix='', call=None, fmt=None, model=None):
+    backend = custom_backends.get(ollama_settings['backend'])
+    if backend:
+        if backend['stream']:
+            yield from backend['stream'](prefix + prompt)
+        else:
+            yield backend['generate'](prefix + prompt)
+        return
+    if ollama_settings['backend'] == 'http':
+        started = False
+        try:
+            context = get_prefix_context(prefix, model) if prefix and ollama_settings['reuse_context'] else None
+            if context:
+                chunks = stream_ollama_http(prompt, context, call, fmt, model)
+            else:
+                chunks = stream_ollama_http(prefix + prompt, call=call, fmt=fmt, model=model)
+            for chunk in chunks:
+                started = True
+                yield chunk
+            return
+        except (get_requests().RequestException, ValueError, RuntimeError) as e:
+            # Once tokens have been handed downstream there is no clean way to switch backends
+            if started or not ollama_settings['cli_fallback']:
+                logging.error(f"Ollama HTTP stream failed: {e}")
+                if call is not None:
+                    call['stream_failed'] = True
+                return
+            logging.warning(f"Ollama HTTP stream unavailable ({e}), falling back to 'ollama run'")
+            if call is not None:
+                call['fallback'] = True
+    yield from stream_ollama_cli(prefix + prompt, model, call)
+
+def stream_ollama(prompt, prefix='', stage=None, fmt=None, outcome=None):
+    # A consumer that stops reading once it has everything it asked for sets
+    # outcome['response'] to that complete answer before closing the stream; the call then
+    # counts as complete and the answer is cached in place of the cut-off text.
+    call = start_llm_call(stage)
+    cached = get_cached_response(prefix + prompt, stage)
+    if cached is not None:
+        call['cache_hit'] = True
+        finish_llm_call(call, cached)
+        yield cached
+        return
+    chunks = []
+    complete = False
+    try:
+        wait_start = time.perf_counter()
+        with llm_slots or nullcontext():
+            call['wait_time'] = time.perf_counter() - wait_start
+            call['deadline'] = stage_deadline(stage)
+            call_start = time.perf_counter()
+            for chunk in dispatch_ollama_stream(prompt, prefix, call, fmt, model_for(stage)):
+                chunks.append(chunk)
+                yield chunk
+        # The backends log and stop on a mid-stream failure instead of raising into the parser
+        complete = not call.get('stream_failed')
+        # Cut-off streams say nothing about how long a full generation takes
+        record_call_latency(stage, time.perf_counter() - call_start, bool(chunks) and complete)
+    finally:
+        response = ''.join(chunks).strip()
+        if not complete and outcome and outcome.get('response') and not call.get('stream_failed'):
+            complete = True
+            response = outcome['response']
+        call['cut_off'] = not complete
+        finish_llm_call(call, response)
+        log_payload("LLM Response", response)
+        # Only complete answers are cached; a cut-off stream would not parse as a whole
+        if complete:
+            store_cached_response(prefix + prompt, response, stage)
+
+def normalize_character(char):
+    return {
+        'name': char.get('Name', char.get('name', 'Unknown')),
+        'age': char.get('Age', char.get('age', 'Unknown')),
+        'description': char.get('Description', char.get('description', '')),
+        'clothing': char.get('Clothing', char.get('clothing', '')),
+        'role': char.get('Role', char.get('role', ''))
+    }
+
+def normalize_scene(scene):
+    return {
+        'Scene': scene.get('Scene', 'Unknown'),
+        'Voiceover': scene.get('Voiceover', ''),
+        'Description': scene.get('Description', '')
+    }
+
+def iter_json_array_objects(chunks):
+    # Incrementally scans streamed text for the first top-level JSON array and yields
+    # each object in it as soon as its closing brace arrives.
+    text = ''
+    pos = 0
+    depth = 0
+    in_string = False
+    escape = False
+    obj_start = None
+    try:
+        for chunk in chunks:
+            text += chunk
+            while pos < len(text):
+                ch = text[pos]
+                if depth == 0:
+                    if ch == '[':
+                        depth = 1
+                elif in_string:
+                    if escape:
+                        escape = False
+                    elif ch == '\\':
+                        escape = True
+                    elif ch == '"':
+                        in_string = False
+                elif ch == '"':
+                    in_string = True
+                elif ch in '[{':
+                    if depth == 1 and ch == '{':
+                        obj_start = pos
+                    depth += 1
+                elif ch in ']}':
+                    depth -= 1
+                    if depth == 0:
+                        return
+                    if depth == 1 and obj_start is not None:
+                        try:
+                            yield json.loads(remove_trailing_commas(text[obj_start:pos + 1]))
+                        except json.JSONDecodeError as e:
+                            logging.warning(f"Skipping malformed streamed JSON object: {e}")
+                        obj_start = None
+                pos += 1
+            # Drop text that can no longer be part of a pending object
+            keep_from = obj_start if obj_start is not None else pos
+            text = text[keep_from:]
+            pos -= keep_from
+            if obj_start is not None:
+                obj_start = 0
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+# JSON schemas sent as Ollama's structured-output format for each stage
+CHARACTERS_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {
+            'Name': {'type': 'string'},
+            'Age': {'type': 'string'},
+            'Description': {'type': 'string'},
+            'Clothing': {'type': 'string'},
+            'Role': {'type': 'string'}
+        },
+        'required': ['Name', 'Age', 'Description', 'Clothing', 'Role']
+    }
+}
+
+SCENES_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {
+            'Scene': {'type': 'string'},
+            'Voiceover': {'type': 'string'},
+            'Description': {'type': 'string'}
+        },
+        'required': ['Scene', 'Voiceover', 'Description']
+    }
+}
+
+SCENE_PROMPT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'Name': {'type': 'string'},
+        'Positive prompt': {'type': 'string'},
+        'Negative prompt': {'type': 'string'}
+    },
+    'required': ['Name', 'Positive prompt', 'Negative prompt']
+}
+
+SCENE_PROMPT_BATCH_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': dict(SCENE_PROMPT_SCHEMA['properties'], Index={'type': 'integer'}),
+        'required': ['Index'] + SCENE_PROMPT_SCHEMA['required']
+    }
+}
+
+def strip_code_fences(text):
+    return re.sub(r"```[A-Za-z]*", "", text)
+
+def remove_trailing_commas(text):
+    # Drops commas directly before a closing bracket or brace, outside of strings
+    out = []
+    in_string = False
+    escape = False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in ']}':
+            idx = len(out) - 1
+            while idx >= 0 and out[idx].isspace():
+                idx -= 1
+            if idx >= 0 and out[idx] == ',':
+                del out[idx]
+        out.append(ch)
+    return ''.join(out)
+
+def close_truncated_json(text):
+    # Closes an unterminated string and any open brackets so a cut-off object can load
+    closers = []
+    in_string = False
+    escape = False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '[{':
+            closers.append(']' if ch == '[' else '}')
+        elif ch in ']}' and closers:
+            closers.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(',:')
+    return remove_trailing_commas(text + ''.join(reversed(closers)))
+
+def load_json_array(response, label):
+    # Parses the JSON array in a model response, repairing code fences and trailing
+    # commas; from a truncated or otherwise damaged array, every complete object is kept.
+    text = remove_trailing_commas(strip_code_fences(response or ''))
+    start = text.find('[')
+    if start == -1:
+        obj = load_json_object(text, label) if '{' in text else {}
+        if obj:
+            return [obj]
+        logging.error(f"No JSON array found in {label} response")
+        return []
+    end = text.rfind(']') + 1
+    if end > start:
+        try:
+            parsed = json.loads(text[start:end])
+            if isinstance(parsed, list):
+                return [item for item in parsed if isinstance(item, dict)]
+            logging.error(f"Parsed {label} JSON is not an array")
             return []
-            
-        characters = []
-        for char in parsed:
-            if isinstance(char, dict):
-                normalized = {
-                    'name': char.get('Name', char.get('name', 'Unknown')),
-                    'age': char.get('Age', char.get('age', 'Unknown')),
-                    'description': char.get('Description', char.get('description', '')),
-                    'clothing': char.get('Clothing', char.get('clothing', '')),
-                    'role': char.get('Role', char.get('role', ''))
-                }
-                characters.append(normalized)
-        
+        except json.JSONDecodeError as e:
+            logging.warning(f"JSON parsing error ({label}): {e}, recovering complete objects")
+    items = [obj for obj in iter_json_array_objects(iter([text[start:]])) if isinstance(obj, dict)]
+    if items:
+        logging.info(f"Recovered {len(items)} {label} from a damaged JSON array")
+    else:
+        log_payload("Attempted to parse", text[start:])
+    return items
+
+def load_json_object(response, label):
+    text = remove_trailing_commas(strip_code_fences(response or ''))
+    start = text.find('{')
+    if start == -1:
+        logging.error(f"No JSON object found in {label} response")
+        return {}
+    end = text.rfind('}') + 1
+    for candidate in (text[start:end], close_truncated_json(text[start:])):
+        try:
+            parsed = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(parsed, dict):
+            return parsed
+    logging.error(f"JSON parsing error ({label}): could not repair object")
+    log_payload("Attempted to parse", text[start:])
+    return {}
+
+def build_missing_items_prompt(prompt, label, existing, missing):
+    return f"""{prompt}
+A previous answer was incomplete. These {label} were already provided: {json.dumps(existing)}.
+Provide ONLY the {missing} remaining {label}, as a JSON array of {missing} objects in the same format.
+"""
+
+def parse_json_response_characters(response):
+    try:
+        characters = [normalize_character(char) for char in load_json_array(response, 'characters')]
+
         if characters:
             logging.info(f"Successfully parsed {len(characters)} characters")
             return characters
         else:
             logging.warning("No valid character data found in JSON")
             return []
-            
-    except json.JSONDecodeError as e:
-        logging.error(f"JSON parsing error (characters): {e}")
-        logging.debug(f"Attempted to parse: {json_str}")
-        return []
+
     except Exception as e:
         logging.error(f"Unexpected error during character parsing: {e}")
-        logging.debug(f"Raw response:\n{response}")
+        log_payload("Raw response", response)
         return []
 
 def parse_json_response_scenes(response):
     try:
-        start = response.find('[')
-        end = response.rfind(']') + 1
-        
-        if start == -1 or end == 0:
-            logging.error("No JSON array found in scene response")
-            return []
-            
-        json_str = response[start:end]
-        parsed = json.loads(json_str)
-        
-        if not isinstance(parsed, list):
-            logging.error("Parsed scene JSON is not an array")
-            return []
-            
-        scenes = []
-        for scene in parsed:
-            if isinstance(scene, dict):
-                normalized = {
-                    'Scene': scene.get('Scene', 'Unknown'),
-                    'Voiceover': scene.get('Voiceover', ''),
-                    'Description': scene.get('Description', '')
-                }
-                scenes.append(normalized)
-        
+        scenes = [normalize_scene(scene) for scene in load_json_array(response, 'scenes')]
+
         if scenes:
             logging.info(f"Successfully parsed {len(scenes)} scenes")
             return scenes
         else:
             logging.warning("No valid scene data found in JSON")
             return []
-            
-    except json.JSONDecodeError as e:
-        logging.error(f"JSON parsing error (scenes): {e}")
-        logging.debug(f"Attempted to parse: {json_str}")
-        return []
+
     except Exception as e:
         logging.error(f"Unexpected error during scene parsing: {e}")
-        logging.debug(f"Raw response:\n{response}")
+        log_payload("Raw response", response)
         return []
 
-def identify_characters(voiceover_text, num_characters):
-    prompt = f"""
+def build_story_prefix(voiceover_text):
+    # Shared, byte-identical lead-in for every story-level prompt so it can be reused
+    # from Ollama's context/KV cache instead of being evaluated again per stage
+    return f"""
+Voiceover Text:
+{voiceover_text}
+"""
+
+def build_character_sheet_prefix(characters):
+    return f"""
+Available Characters:
+{json.dumps(characters, indent=2)}
+"""
+
+def build_characters_prompt(num_characters):
+    return f"""
 You are a visual storyteller creating character descriptions.
 
 Instructions:
-- Analyze the voiceover text and identify {num_characters} key characters.
+- Analyze the voiceover text above and identify {num_characters} key characters.
 - Create detailed but concise visual descriptions for each character.
 - Ensure each description is clear enough to maintain consistency across scenes.
 
@@ -179,18 +1262,279 @@ For each character, provide:
 - "Role": Their function in the story
 
 Format as JSON array with {num_characters} character objects.
-
-Voiceover Text:
-{voiceover_text}
 """
-    logging.debug(f"Identify Characters Prompt:\n{prompt}")
-    response = run_ollama(prompt)
-    logging.debug(f"Identify Characters Response:\n{response}")
+
+# Long voiceovers are split into overlapping chunks that are processed in parallel
+# (map) and merged (reduce), so no prompt outgrows the model's context window.
+# Chunking is off while size is 0; sizes are in characters (~4 per token).
+chunk_settings = {
+    'size': 0,
+    'overlap': 400
+}
+
+NAME_TITLES = {'mr', 'mrs', 'ms', 'miss', 'dr', 'doctor', 'prof', 'professor', 'sir', 'lady', 'lord', 'the'}
+
+def configure_chunking(size=None, overlap=None):
+    if size is not None:
+        chunk_settings['size'] = size
+    if overlap is not None:
+        chunk_settings['overlap'] = overlap
+
+def needs_chunking(voiceover_text):
+    return chunk_settings['size'] > 0 and len(voiceover_text) > chunk_settings['size']
+
+def split_text_units(text, size):
+    # Paragraphs, then sentences, then hard cuts, until every unit fits in size
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= size:
+            units.append(paragraph)
+            continue
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            while len(sentence) > size:
+                units.append(sentence[:size])
+                sentence = sentence[size:]
+            if sentence:
+                units.append(sentence)
+    return units
+
+def split_voiceover(voiceover_text, size, overlap):
+    """Splits text into chunks of at most size characters on paragraph or sentence
+    boundaries. Each chunk repeats up to overlap characters from the end of the previous
+    one so that scenes and characters spanning a boundary are not cut in half.
+
+    Returns (chunk, new_length) pairs, where new_length excludes the repeated overlap.
+    """
+    separator = "\n\n"
+    overlap = min(overlap, size // 2)
+    # The carried text and its separator share the overlap, so no chunk exceeds size
+    carry = max(overlap - len(separator), 0)
+    units = split_text_units(voiceover_text, size - overlap)
+    chunks = []
+    current = []
+    for unit in units:
+        if current and sum(len(part) + 2 for part in current) + len(unit) > size - overlap:
+            chunks.append(current)
+            current = []
+        current.append(unit)
+    if current:
+        chunks.append(current)
+
+    result = []
+    for idx, parts in enumerate(chunks):
+        body = "\n\n".join(parts)
+        carried = ""
+        if idx > 0 and carry:
+            previous = separator.join(chunks[idx - 1])
+            carried = previous[-carry:]
+            # Start the carried text at a word boundary
+            carried = carried[carried.find(' ') + 1:] if ' ' in carried else carried
+        result.append(((carried + separator + body) if carried else body, len(body)))
+    return result
+
+def allocate_scenes(lengths, num_scenes):
+    # Largest remainder split of num_scenes in proportion to each chunk's new text
+    total = sum(lengths) or 1
+    shares = [num_scenes * length / total for length in lengths]
+    counts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(shares)), key=lambda idx: shares[idx] - counts[idx], reverse=True)
+    for idx in by_remainder[:num_scenes - sum(counts)]:
+        counts[idx] += 1
+    return counts
+
+def map_chunks(function, jobs):
+    # Chunk calls run in parallel in the caller's context; llm_slots still bounds them
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, function, *job) for job in jobs]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.error(f"Chunk processing failed: {e}")
+                results.append([])
+        return results
+
+def name_tokens(name):
+    tokens = re.findall(r"[\w']+", str(name).lower())
+    return frozenset(token for token in tokens if token not in NAME_TITLES) or frozenset(tokens)
+
+def merge_characters(candidates, num_characters):
+    """Merges characters found in several chunks. Names match when one name's tokens
+    (ignoring titles) are a subset of the other's, so "Leon" and "Dr. Leon Gabor" are one
+    character. The characters seen in the most chunks are kept, in order of appearance.
+    """
+    merged = []
+    for char in candidates:
+        tokens = name_tokens(char['name'])
+        for entry in merged:
+            if tokens and (tokens <= entry['tokens'] or entry['tokens'] <= tokens):
+                if len(tokens) > len(entry['tokens']):
+                    entry['data']['name'] = char['name']
+                entry['tokens'] = entry['tokens'] | tokens
+                for key, value in char.items():
+                    if value and entry['data'].get(key) in ('', 'Unknown', None):
+                        entry['data'][key] = value
+                entry['hits'] += 1
+                break
+        else:
+            merged.append({'data': dict(char), 'tokens': tokens, 'hits': 1, 'order': len(merged)})
+    kept = sorted(merged, key=lambda entry: (-entry['hits'], entry['order']))[:num_characters]
+    return [entry['data'] for entry in sorted(kept, key=lambda entry: entry['order'])]
+
+# The chunk workers call the single-request functions directly: a chunk is never chunked again
+
+def identify_characters_chunked(voiceover_text, num_characters):
+    chunks = split_voiceover(voiceover_text, chunk_settings['size'], chunk_settings['overlap'])
+    logging.info(f"Identifying characters in {len(chunks)} chunks")
+    found = map_chunks(identify_characters_single, [(chunk, num_characters, False) for chunk, _ in chunks])
+    characters = merge_characters([char for chars in found for char in chars], num_characters)
+    if characters and len(characters) < num_characters:
+        # A single top-up over the chunk with the most text, naming everyone found so far
+        chunk = max(chunks, key=lambda item: item[1])[0]
+        extra = request_missing_items(
+            build_story_prefix(chunk), build_characters_prompt(num_characters), 'characters',
+            [char['name'] for char in characters], num_characters - len(characters),
+            'characters', CHARACTERS_SCHEMA, parse_json_response_characters
+        )
+        characters = merge_characters(characters + extra, num_characters)
+    return characters
+
+def suggest_chunk_scenes(chunk, num_scenes, known_names):
+    if not known_names:
+        return suggest_scenes_single(chunk, num_scenes, follow_up=False)
+    return request_missing_items(
+        build_story_prefix(chunk), build_scenes_prompt(num_scenes), 'scenes', known_names,
+        num_scenes, 'scenes', SCENES_SCHEMA, parse_json_response_scenes
+    )
+
+def scene_voiceover_key(scene):
+    return " ".join(scene['Voiceover'].lower().split())
+
+def suggest_scenes_chunked(voiceover_text, num_scenes, existing=()):
+    """Suggests scenes chunk by chunk until there are num_scenes, counting the existing
+    scenes kept from an earlier run, and returns only the new ones. Scenes from the overlap
+    can come back twice and are dropped by voiceover line; a second round asks the chunks
+    for whatever the first one left short, naming the scenes already known.
+    """
+    chunks = split_voiceover(voiceover_text, chunk_settings['size'], chunk_settings['overlap'])
+    lengths = [length for _, length in chunks]
+    scenes = []
+    seen_voiceovers = {scene_voiceover_key(scene) for scene in existing}
+    seen_names = {scene['Scene'] for scene in existing}
+    for _ in range(2):
+        missing = num_scenes - len(existing) - len(scenes)
+        if missing <= 0:
+            break
+        known_names = [scene['Scene'] for scene in existing] + [scene['Scene'] for scene in scenes]
+        counts = allocate_scenes(lengths, missing)
+        parts = [part for part, count in enumerate(counts, 1) if count]
+        logging.info(f"Suggesting {missing} scenes in {len(chunks)} chunks: {counts}")
+        found = map_chunks(suggest_chunk_scenes, [
+            (chunks[part - 1][0], counts[part - 1], known_names) for part in parts
+        ])
+        for part, chunk_scenes in zip(parts, found):
+            for scene in chunk_scenes[:counts[part - 1]]:
+                voiceover_key = scene_voiceover_key(scene)
+                if voiceover_key and voiceover_key in seen_voiceovers:
+                    continue
+                seen_voiceovers.add(voiceover_key)
+                # Identifiers must stay unique, also against the scenes kept from earlier
+                name = scene['Scene']
+                suffix = part
+                while name in seen_names:
+                    name = f"{scene['Scene']} (part {suffix})"
+                    suffix += 1
+                seen_names.add(name)
+                scenes.append(dict(scene, Scene=name))
+    return scenes[:max(num_scenes - len(existing), 0)]
+
+def request_missing_items(prefix, prompt, label, existing, missing, stage, fmt, parse):
+    # Last resort once repair has kept what it could: ask only for the missing items
+    followup = build_missing_items_prompt(prompt, label, existing, missing)
+    logging.info(f"Requesting {missing} missing {label} from the model")
+    log_payload(f"Missing {label} prompt", prefix, followup)
+    response = run_ollama(followup, prefix, stage=stage, fmt=fmt)
+    items = parse(response)
+    if not items:
+        if response:
+            record_parse_failure(stage)
+        invalidate_cached_response(prefix + followup, stage)
+    return items[:missing]
+
+def identify_characters(voiceover_text, num_characters):
+    if needs_chunking(voiceover_text):
+        return identify_characters_chunked(voiceover_text, num_characters)
+    return identify_characters_single(voiceover_text, num_characters)
+
+def identify_characters_single(voiceover_text, num_characters, follow_up=True):
+    # One request over the whole text, however long. Chunk workers pass follow_up=False:
+    # a chunk often holds fewer characters than the story, and the merge tops up instead
+    prefix = build_story_prefix(voiceover_text)
+    prompt = build_characters_prompt(num_characters)
+    log_payload("Identify Characters Prompt", prefix, prompt)
+    response = run_ollama(prompt, prefix, stage='characters', fmt=CHARACTERS_SCHEMA)
+    log_payload("Identify Characters Response", response)
     characters = parse_json_response_characters(response)
-    if characters is None:
-        characters = []
+    if not characters:
+        if response:
+            record_parse_failure('characters')
+        # Do not let an unusable response be replayed from the cache on the next run
+        invalidate_cached_response(prefix + prompt, 'characters')
+        return []
+    if follow_up and len(characters) < num_characters:
+        known = {char['name'].lower() for char in characters}
+        extra = request_missing_items(
+            prefix, prompt, 'characters', [char['name'] for char in characters], num_characters - len(characters),
+            'characters', CHARACTERS_SCHEMA, parse_json_response_characters
+        )
+        characters += [char for char in extra if char['name'].lower() not in known]
     return characters
 
+def stream_characters(voiceover_text, num_characters):
+    # Yields characters as their JSON objects close and stops the model once enough arrived
+    if needs_chunking(voiceover_text):
+        # Chunks are merged before anything can be yielded
+        yield from identify_characters_chunked(voiceover_text, num_characters)
+        return
+    prefix = build_story_prefix(voiceover_text)
+    prompt = build_characters_prompt(num_characters)
+    log_payload("Identify Characters Prompt (streaming)", prefix, prompt)
+    names = []
+    kept = []
+    # Stopping at the last wanted object still counts as a complete answer for the cache
+    outcome = {}
+    objects = iter_json_array_objects(stream_ollama(prompt, prefix, stage='characters', fmt=CHARACTERS_SCHEMA, outcome=outcome))
+    try:
+        for obj in objects:
+            if isinstance(obj, dict):
+                character = normalize_character(obj)
+                names.append(character['name'])
+                kept.append(obj)
+                if len(names) >= num_characters:
+                    outcome['response'] = json.dumps(kept, indent=2)
+                yield character
+                if len(names) >= num_characters:
+                    break
+    finally:
+        objects.close()
+    if not names:
+        record_parse_failure('characters')
+        invalidate_cached_response(prefix + prompt, 'characters')
+    elif len(names) < num_characters:
+        known = {name.lower() for name in names}
+        for character in request_missing_items(
+            prefix, prompt, 'characters', names, num_characters - len(names),
+            'characters', CHARACTERS_SCHEMA, parse_json_response_characters
+        ):
+            if character['name'].lower() not in known:
+                yield character
+
 def generate_negative_prompt():
     negative_prompt = "Cartoonish features, supernatural elements, exaggerated expressions, bright colors, unrealistic poses, inconsistent lighting, text, blurry details, distorted proportions"
     logging.info(f"Using negative prompt: {negative_prompt}")
@@ -215,11 +1559,11 @@ def generate_character_prompts(characters, negative_prompt):
         prompts.append(prompt_data)
     return prompts
 
-def suggest_scenes(voiceover_text, num_scenes):
-    prompt = f"""
+def build_scenes_prompt(num_scenes):
+    return f"""
 You are a visual storyteller specializing in psychological narratives.
 
-Create {num_scenes} powerful visual scenes that:
+Based on the voiceover text above, create {num_scenes} powerful visual scenes that:
 - Show psychological states, behaviors, or social phenomena
 - Can include both individual experiences or group dynamics
 - Build tension and progression in the story
@@ -237,28 +1581,205 @@ For each scene provide:
   * Atmospheric elements
 
 Format as JSON array with {num_scenes} scene objects.
-
-Voiceover Text:
-{voiceover_text}
 """
-    logging.debug(f"Suggest Scenes Prompt:\n{prompt}")
-    response = run_ollama(prompt)
-    logging.debug(f"Suggest Scenes Response:\n{response}")
+
+def suggest_scenes(voiceover_text, num_scenes):
+    if needs_chunking(voiceover_text):
+        return suggest_scenes_chunked(voiceover_text, num_scenes)
+    return suggest_scenes_single(voiceover_text, num_scenes)
+
+def suggest_scenes_single(voiceover_text, num_scenes, follow_up=True):
+    # One request over the whole text, however long; see identify_characters_single
+    prefix = build_story_prefix(voiceover_text)
+    prompt = build_scenes_prompt(num_scenes)
+    log_payload("Suggest Scenes Prompt", prefix, prompt)
+    response = run_ollama(prompt, prefix, stage='scenes', fmt=SCENES_SCHEMA)
+    log_payload("Suggest Scenes Response", response)
     scenes = parse_json_response_scenes(response)
-    if scenes is None:
-        scenes = []
+    if not scenes:
+        if response:
+            record_parse_failure('scenes')
+        invalidate_cached_response(prefix + prompt, 'scenes')
+        return []
+    if follow_up and len(scenes) < num_scenes:
+        scenes += request_missing_items(
+            prefix, prompt, 'scenes', [scene['Scene'] for scene in scenes], num_scenes - len(scenes),
+            'scenes', SCENES_SCHEMA, parse_json_response_scenes
+        )
     return scenes
 
-def generate_scene_prompts(scenes, characters, negative_prompt):
-    prompts = []
-    for scene in tqdm(scenes, desc="Generating scene prompts"):
-        while paused:
-            time.sleep(0.1)
-                
-        llm_prompt = f"""
+def extend_scenes(voiceover_text, scenes, num_scenes):
+    # Asks only for the scenes beyond the ones already kept from an earlier run
+    if needs_chunking(voiceover_text):
+        return suggest_scenes_chunked(voiceover_text, num_scenes, existing=scenes)
+    prefix = build_story_prefix(voiceover_text)
+    return request_missing_items(
+        prefix, build_scenes_prompt(num_scenes), 'scenes', [scene['Scene'] for scene in scenes],
+        num_scenes - len(scenes), 'scenes', SCENES_SCHEMA, parse_json_response_scenes
+    )
+
+def stream_scenes(voiceover_text, num_scenes):
+    if needs_chunking(voiceover_text):
+        # Chunks are merged before anything can be yielded
+        yield from suggest_scenes_chunked(voiceover_text, num_scenes)
+        return
+    prefix = build_story_prefix(voiceover_text)
+    prompt = build_scenes_prompt(num_scenes)
+    log_payload("Suggest Scenes Prompt (streaming)", prefix, prompt)
+    names = []
+    kept = []
+    # Stopping at the last wanted object still counts as a complete answer for the cache
+    outcome = {}
+    objects = iter_json_array_objects(stream_ollama(prompt, prefix, stage='scenes', fmt=SCENES_SCHEMA, outcome=outcome))
+    try:
+        for obj in objects:
+            if isinstance(obj, dict):
+                scene = normalize_scene(obj)
+                names.append(scene['Scene'])
+                kept.append(obj)
+                if len(names) >= num_scenes:
+                    outcome['response'] = json.dumps(kept, indent=2)
+                yield scene
+                if len(names) >= num_scenes:
+                    break
+    finally:
+        objects.close()
+    if not names:
+        record_parse_failure('scenes')
+        invalidate_cached_response(prefix + prompt, 'scenes')
+    elif len(names) < num_scenes:
+        yield from request_missing_items(
+            prefix, prompt, 'scenes', names, num_scenes - len(names),
+            'scenes', SCENES_SCHEMA, parse_json_response_scenes
+        )
+
+# Scene prompts can carry a compact character sheet holding only the characters the
+# scene mentions, one line each, trimmed to fit a per-call token budget (0 = no budget).
+# Prompt length drives latency on CPU inference, so the sheet is the first thing to cut.
+compaction_settings = {
+    'enabled': False,
+    'token_budget': 0
+}
+
+# Estimated tokens of the full character sheets vs. the compact ones actually sent
+compaction_stats = {'calls': 0, 'full_tokens': 0, 'compact_tokens': 0, 'saved_tokens': 0, 'dropped_characters': 0}
+_compaction_stats_lock = threading.Lock()
+
+def configure_compaction(enabled=None, token_budget=None):
+    if enabled is not None:
+        compaction_settings['enabled'] = enabled
+    if token_budget is not None:
+        compaction_settings['token_budget'] = token_budget
+
+def estimate_tokens(text):
+    """Approximates the model's token count without loading its tokenizer. Mirrors a BPE
+    pre-tokenizer: words split into pieces of up to six characters, digits into groups of
+    three, and every punctuation mark and newline-plus-indentation run is one token.
+    """
+    tokens = 0
+    for piece in re.findall(r"\n[ \t]*|[^\W\d_]+|\d+|[^\w\s]", str(text)):
+        if piece[0].isalpha():
+            tokens += (len(piece) + 5) // 6
+        elif piece[0].isdigit():
+            tokens += (len(piece) + 2) // 3
+        else:
+            tokens += 1
+    return tokens
+
+def mention_counts(scenes, characters):
+    # How often any part of each character's name (titles ignored) occurs in the scenes'
+    # voiceover and description; "Leon's" counts for Leon Gabor
+    words = {}
+    for scene in scenes:
+        text = f"{scene.get('Voiceover', '')} {scene.get('Description', '')}".lower()
+        for word in re.findall(r"[\w']+", text):
+            word = word[:-2] if word.endswith("'s") else word
+            words[word] = words.get(word, 0) + 1
+    return [sum(words.get(token, 0) for token in name_tokens(char.get('name', ''))) for char in characters]
+
+def compact_character_lines(char):
+    # Progressively shorter forms of one character: everything, without the role, and
+    # just the name and age
+    def field(key):
+        value = str(char.get(key, '')).strip().rstrip('.')
+        return '' if value.lower() in ('', 'unknown') else value
+
+    head = field('name') or 'Unknown'
+    if field('age'):
+        head += f" ({field('age')})"
+    details = [field('description'), f"wears {field('clothing')}" if field('clothing') else '']
+    full = [part for part in details + [field('role')] if part]
+    short = [part for part in details if part]
+    lines = [f"- {head}: {'; '.join(full)}" if full else f"- {head}"]
+    if short != full:
+        lines.append(f"- {head}: {'; '.join(short)}" if short else f"- {head}")
+    if short:
+        lines.append(f"- {head}")
+    return lines
+
+def build_compact_character_sheet(scenes, characters, prompt):
+    """Returns the compact character sheet for a scene prompt request covering scenes.
+
+    Characters mentioned by name come first, most mentioned first; when nobody is named
+    every character is a candidate, in story order. With a token budget, characters are
+    shortened and then dropped until the sheet plus prompt fits.
+    """
+    full_sheet = build_character_sheet_prefix(characters)
+
+    counts = mention_counts(scenes, characters)
+    order = [idx for idx in range(len(characters)) if counts[idx]]
+    order.sort(key=lambda idx: -counts[idx])
+    if not order:
+        order = list(range(len(characters)))
+
+    header = "\nAvailable Characters:\n"
+    budget = compaction_settings['token_budget']
+    remaining = budget - estimate_tokens(header + prompt) if budget else None
+    if remaining is not None and remaining <= 0:
+        logging.warning(f"Scene prompt alone is estimated at {budget - remaining} tokens, over the "
+                        f"{budget} token budget; sending it without a character sheet")
+    lines = []
+    for idx in order:
+        if remaining is not None and remaining <= 0:
+            break
+        for line in compact_character_lines(characters[idx]):
+            cost = estimate_tokens(line + "\n")
+            if remaining is None or cost <= remaining:
+                lines.append(line)
+                if remaining is not None:
+                    remaining -= cost
+                break
+    sheet = header + "\n".join(lines) + "\n" if lines else ""
+
+    full_tokens = estimate_tokens(full_sheet)
+    compact_tokens = estimate_tokens(sheet)
+    with _compaction_stats_lock:
+        compaction_stats['calls'] += 1
+        compaction_stats['full_tokens'] += full_tokens
+        compaction_stats['compact_tokens'] += compact_tokens
+        compaction_stats['saved_tokens'] += max(full_tokens - compact_tokens, 0)
+        compaction_stats['dropped_characters'] += len(order) - len(lines)
+    return sheet
+
+def scene_prompt_parts(scenes, characters, prompt):
+    # Returns (prefix, prompt). The full sheet is the same for every scene of a story, so
+    # it is the shared prefix --reuse-context evaluates once. A compact sheet differs per
+    # request and goes into the prompt, where it never costs an extra priming call.
+    if not compaction_settings['enabled'] or not characters:
+        return build_character_sheet_prefix(characters), prompt
+    return '', build_compact_character_sheet(scenes, characters, prompt) + prompt
+
+def print_compaction_summary():
+    if compaction_stats['calls']:
+        print(f"\nCharacter sheets: ~{compaction_stats['compact_tokens']} tokens sent instead of "
+              f"~{compaction_stats['full_tokens']} over {compaction_stats['calls']} scene prompt requests, "
+              f"~{compaction_stats['saved_tokens']} saved")
+
+def generate_scene_prompt(scene, characters, negative_prompt):
+    llm_prompt = f"""
 You are a visual storyteller creating prompts for psychological narratives.
 
-Create a clear, impactful scene description that:
+Using the characters above where relevant, create a clear, impactful scene description that:
 1. Starts with the main visual element/action
 2. Includes relevant character details when needed:
    - Main characters: [name], [age], [appearance], [clothing], [action/state]
@@ -273,9 +1794,6 @@ Scene Information:
 - Voiceover: {scene['Voiceover']}
 - Description: {scene['Description']}
 
-Available Characters:
-{json.dumps(characters, indent=2)}
-
 Create a JSON object with:
 - "Name": Scene identifier
 - "Positive prompt": Brief, powerful scene description. MUST end with "Comic book-style illustration with a dark, gritty, realistic vibe."
@@ -283,80 +1801,1143 @@ Create a JSON object with:
 
 Format as single JSON object.
 """
-        logging.debug(f"Generate Scene Prompt for {scene['Scene']}:\n{llm_prompt}")
-        response = run_ollama(llm_prompt)
-        logging.debug(f"Generate Scene Response for {scene['Scene']}:\n{response}")
+    prefix, llm_prompt = scene_prompt_parts([scene], characters, llm_prompt)
+    # Blocks while the user has paused processing with F6
+    resume_event.wait()
+    log_payload(f"Generate Scene Prompt for {scene['Scene']}", prefix, llm_prompt)
+    # The second attempt is the last resort after repair, pointing the model at the format problem
+    for attempt_prompt in (llm_prompt, llm_prompt + "\nYour previous answer could not be parsed. Respond with only the JSON object.\n"):
+        response = run_ollama(attempt_prompt, prefix, stage='scene_prompts', fmt=SCENE_PROMPT_SCHEMA)
+        log_payload(f"Generate Scene Response for {scene['Scene']}", response)
         scene_prompt = parse_json_response_scene_prompts(response)
         if scene_prompt:
             if 'positive prompt' in scene_prompt:
-                positive_prompt = scene_prompt.get("positive prompt", "")
-                if "Comic book-style illustration" not in positive_prompt:
-                    positive_prompt += " Comic book-style illustration with a dark, gritty, realistic vibe."
-                prompts.append({
-                    "Name": scene_prompt.get("name", scene['Scene']),
-                    "Positive prompt": positive_prompt,
-                    "Negative prompt": negative_prompt
-                })
+                return finalize_scene_prompt(scene_prompt, scene, negative_prompt)
             else:
                 logging.error(f"Missing keys in scene prompt for scene: {scene['Scene']}")
         else:
             logging.error(f"Failed to generate prompt for scene: {scene['Scene']}")
-    return prompts
+        invalidate_cached_response(prefix + attempt_prompt, 'scene_prompts')
+        if not response:
+            break
+        record_parse_failure('scene_prompts')
+    return None
+
+def finalize_scene_prompt(scene_prompt, scene, negative_prompt):
+    positive_prompt = scene_prompt.get("positive prompt", "")
+    if "Comic book-style illustration" not in positive_prompt:
+        positive_prompt += " Comic book-style illustration with a dark, gritty, realistic vibe."
+    return {
+        "Name": scene_prompt.get("name", scene['Scene']),
+        "Positive prompt": positive_prompt,
+        "Negative prompt": negative_prompt
+    }
+
+def generate_scene_prompt_batch(batch, characters, negative_prompt):
+    # One request covers every scene in the batch so the instructions and character
+    # sheet are sent once; scenes the model drops or mangles are retried one by one.
+    if len(batch) == 1:
+        return [generate_scene_prompt(batch[0], characters, negative_prompt)]
+
+    scene_list = "\n".join(
+        f"{number}. Scene: {scene['Scene']}\n   Voiceover: {scene['Voiceover']}\n   Description: {scene['Description']}"
+        for number, scene in enumerate(batch, 1)
+    )
+    llm_prompt = f"""
+You are a visual storyteller creating prompts for psychological narratives.
+
+For EACH scene below, using the characters above where relevant, create a clear, impactful scene description that:
+1. Starts with the main visual element/action
+2. Includes relevant character details when needed:
+   - Main characters: [name], [age], [appearance], [clothing], [action/state]
+   - Group dynamics: Clear but brief descriptions of crowd behavior
+3. Adds environmental details that reflect psychological states
+4. Keeps descriptions concise but powerful
+5. Avoids dialogue or text
+6. Uses visual metaphors Stable Diffusion can create
+
+Scenes:
+{scene_list}
+
+Create a JSON array with exactly {len(batch)} objects, one per scene and in the same order, each with:
+- "Index": The scene number from the list above
+- "Name": Scene identifier
+- "Positive prompt": Brief, powerful scene description. MUST end with "Comic book-style illustration with a dark, gritty, realistic vibe."
+- "Negative prompt": "{negative_prompt}"
+
+Format as JSON array.
+"""
+    prefix, llm_prompt = scene_prompt_parts(batch, characters, llm_prompt)
+    resume_event.wait()
+    log_payload(f"Generate Scene Prompt batch for {len(batch)} scenes", prefix, llm_prompt)
+    response = run_ollama(llm_prompt, prefix, stage='scene_prompts', fmt=SCENE_PROMPT_BATCH_SCHEMA)
+    log_payload("Generate Scene Batch Response", response)
+
+    # load_json_array also recovers the complete objects of a truncated array
+    parsed = []
+    for obj in load_json_array(response, 'scene prompts'):
+        normalized = {str(k).lower(): v for k, v in obj.items()}
+        if normalized.get('positive prompt'):
+            parsed.append(normalized)
+
+    results = [None] * len(batch)
+    by_name = {str(scene['Scene']).strip().lower(): idx for idx, scene in enumerate(batch)}
+    unmatched = []
+    for obj in parsed:
+        # The echoed name decides; the index only places nameless objects, since a model
+        # that numbers from 0 would otherwise shift every prompt onto the wrong scene
+        name = str(obj.get('name') or '').strip().lower()
+        idx = by_name.get(name)
+        if idx is None and not name:
+            try:
+                idx = int(obj.get('index')) - 1
+            except (TypeError, ValueError):
+                idx = None
+        if idx is not None and 0 <= idx < len(batch) and results[idx] is None:
+            results[idx] = finalize_scene_prompt(obj, batch[idx], negative_prompt)
+        else:
+            unmatched.append(obj)
+    # Without usable indexes or names, a complete array can still be matched by position;
+    # an object named after another scene never is
+    if unmatched and len(parsed) == len(batch):
+        for idx, obj in enumerate(parsed):
+            if results[idx] is None and obj in unmatched and str(obj.get('name') or '').strip().lower() not in by_name:
+                results[idx] = finalize_scene_prompt(obj, batch[idx], negative_prompt)
+
+    missing = [idx for idx, prompt in enumerate(results) if prompt is None]
+    if len(missing) == len(batch):
+        invalidate_cached_response(prefix + llm_prompt, 'scene_prompts')
+    if missing and response:
+        record_parse_failure('scene_prompts')
+    if missing:
+        logging.warning(f"Batch response missing {len(missing)} of {len(batch)} scene prompts, retrying them individually")
+    for idx in missing:
+        results[idx] = generate_scene_prompt(batch[idx], characters, negative_prompt)
+    return results
+
+def generate_scene_prompts(scenes, characters, negative_prompt, concurrency=1, show_progress=True,
+                           completed=None, journal_file=None, batch_size=1, on_prompt=None):
+    # scenes may be a list or a stream of scenes; requests are issued as soon as a scene
+    # (or a batch of batch_size scenes) is available. Results are slotted by scene index so
+    # output order never depends on completion order. completed maps scene index to a
+    # journal record to reuse; on_prompt(index, scene, prompt) sees every prompt kept.
+    completed = completed or {}
+    results = []
+    total = len(scenes) if hasattr(scenes, '__len__') else None
+    batch_size = max(batch_size, 1)
+
+    with progress_bar(total=total, desc="Generating scene prompts", disable=not show_progress) as progress:
+
+        def finish(items, future):
+            try:
+                prompts = future.result()
+            except Exception as e:
+                logging.error(f"Error generating prompts for scenes {[scene['Scene'] for _, scene in items]}: {e}")
+                prompts = [None] * len(items)
+            for (idx, scene), prompt in zip(items, prompts):
+                results[idx] = prompt
+                if prompt and journal_file:
+                    append_journal(journal_file, {'type': 'scene_prompt', 'index': idx, 'scene': scene['Scene'], 'data': prompt})
+                if prompt and on_prompt:
+                    on_prompt(idx, scene, prompt)
+                progress.update(1)
+
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+
+            def submit(items):
+                # Run in a copy of the caller's context so calls stay attributed to its story
+                future = executor.submit(contextvars.copy_context().run, generate_scene_prompt_batch,
+                                         [scene for _, scene in items], characters, negative_prompt)
+                future.add_done_callback(lambda future: finish(items, future))
+
+            pending = []
+            for idx, scene in enumerate(scenes):
+                results.append(None)
+                record = completed.get(idx)
+                if record and record.get('scene') == scene['Scene']:
+                    results[idx] = record['data']
+                    if on_prompt:
+                        on_prompt(idx, scene, record['data'])
+                    progress.update(1)
+                    continue
+                pending.append((idx, scene))
+                if len(pending) >= batch_size:
+                    submit(pending)
+                    pending = []
+            if pending:
+                submit(pending)
+    return [prompt for prompt in results if prompt]
 
 def parse_json_response_scene_prompts(response):
     try:
-        response = response.strip('`').strip()
-        json_start = response.find('{')
-        json_end = response.rfind('}') + 1
-        
-        if json_start == -1 or json_end == 0:
-            logging.error("No JSON object found in scene prompt response")
+        parsed = load_json_object(response, 'scene prompts')
+        if not parsed:
             return {}
-        
-        json_str = response[json_start:json_end]
-        parsed = json.loads(json_str)
-        
-        if isinstance(parsed, dict):
-            parsed_normalized = {k.lower(): v for k, v in parsed.items()}
-            if all(k in parsed_normalized for k in ["name", "positive prompt", "negative prompt"]):
-                return parsed_normalized
-            else:
-                logging.error("Parsed scene prompt JSON is missing required keys")
-                return {}
+
+        parsed_normalized = {k.lower(): v for k, v in parsed.items()}
+        if all(k in parsed_normalized for k in ["name", "positive prompt", "negative prompt"]):
+            return parsed_normalized
         else:
-            logging.error("Parsed scene prompt JSON is not an object")
+            logging.error("Parsed scene prompt JSON is missing required keys")
             return {}
-            
-    except json.JSONDecodeError as e:
-        logging.error(f"JSON parsing error (scene prompts): {e}")
-        logging.debug(f"Attempted to parse: {json_str}")
-        return {}
+
     except Exception as e:
         logging.error(f"Unexpected error during scene prompt parsing: {e}")
-        logging.debug(f"Raw response:\n{response}")
+        log_payload("Raw response", response)
         return {}
 
+# Output formats: 'text' is the Name:/Positive prompt:/--- files read by people,
+# 'jsonl' writes one prompt record per line to <story>/prompts.jsonl and a run-level
+# index.jsonl, 'manifest' writes everything about a story to <story>/manifest.json
+OUTPUT_FORMATS = ('text', 'jsonl', 'manifest')
+
+output_settings = {
+    'formats': ['text']
+}
+
+def configure_output(formats=None):
+    if formats is not None:
+        output_settings['formats'] = list(formats)
+
+def write_atomic(file_path, chunks):
+    # Buffered write to a temporary file that only replaces the target once complete, so
+    # downstream readers never pick up a half-written file
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'w', encoding="utf-8", buffering=1 << 20) as f:
+        f.writelines(chunks)
+    os.replace(temp_path, file_path)
+
 def save_prompts(prompts, file_path):
+    def lines():
+        for prompt in prompts:
+            if isinstance(prompt, dict):
+                name = prompt.get('Name', prompt.get('name', 'Unknown'))
+                positive_prompt = prompt.get('Positive prompt', prompt.get('positive prompt', ''))
+                negative_prompt = prompt.get('Negative prompt', prompt.get('negative prompt', ''))
+                yield f"Name: {name}\nPositive prompt: {positive_prompt}\nNegative prompt: {negative_prompt}\n---\n"
+            else:
+                yield f"{prompt}\n"
+
     try:
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w', encoding="utf-8") as f:
-            for prompt in prompts:
-                if isinstance(prompt, dict):
-                    name = prompt.get('Name', prompt.get('name', 'Unknown'))
-                    positive_prompt = prompt.get('Positive prompt', prompt.get('positive prompt', ''))
-                    negative_prompt = prompt.get('Negative prompt', prompt.get('negative prompt', ''))
-                    f.write(f"Name: {name}\nPositive prompt: {positive_prompt}\nNegative prompt: {negative_prompt}\n---\n")
-                else:
-                    f.write(f"{prompt}\n")
+        write_atomic(file_path, lines())
         print(f"Prompts saved to {file_path}")
         logging.info(f"Prompts saved to {file_path}")
     except Exception as e:
         logging.error(f"Error saving prompts to {file_path}: {e}")
 
+def save_chosen_images(scenes, file_path):
+    try:
+        write_atomic(file_path, (f'Name: {scene["Scene"]}\nVoiceover: "{scene["Voiceover"]}"\n---\n' for scene in scenes))
+        print(f"Chosen images saved to {file_path}")
+        logging.info(f"Chosen images saved to {file_path}")
+    except Exception as e:
+        logging.error(f"Error saving chosen images to {file_path}: {e}")
+
+def prompt_record(story_name, kind, index, prompt, scene=None):
+    record = {
+        'story': story_name,
+        'type': kind,
+        'index': index,
+        'name': prompt.get('Name', ''),
+        'positive_prompt': prompt.get('Positive prompt', ''),
+        'negative_prompt': prompt.get('Negative prompt', '')
+    }
+    if scene is not None:
+        record['scene'] = scene['Scene']
+        record['voiceover'] = scene['Voiceover']
+        record['description'] = scene['Description']
+    return record
+
+def save_story_outputs(story_name, story_output_dir, character_prompts, scene_entries):
+    # scene_entries pairs every chosen scene, in order, with its prompt (None if it failed)
+    formats = output_settings['formats']
+    records = [prompt_record(story_name, 'character', idx, prompt) for idx, prompt in enumerate(character_prompts)]
+    records += [prompt_record(story_name, 'scene', idx, prompt, scene)
+                for idx, (scene, prompt) in enumerate(scene_entries) if prompt]
+    if 'jsonl' in formats:
+        file_path = os.path.join(story_output_dir, "prompts.jsonl")
+        try:
+            write_atomic(file_path, (json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            print(f"Prompts saved to {file_path}")
+            logging.info(f"Prompts saved to {file_path}")
+        except Exception as e:
+            logging.error(f"Error saving prompts to {file_path}: {e}")
+    if 'manifest' in formats:
+        file_path = os.path.join(story_output_dir, "manifest.json")
+        manifest = {
+            'story': story_name,
+            'prompt_version': PROMPT_VERSION,
+            'model': model_for('scene_prompts'),
+            'generated': round(time.time(), 3),
+            'characters': [record for record in records if record['type'] == 'character'],
+            'scenes': [{
+                'index': idx,
+                'scene': scene['Scene'],
+                'voiceover': scene['Voiceover'],
+                'description': scene['Description'],
+                'prompt': {
+                    'name': prompt.get('Name', ''),
+                    'positive_prompt': prompt.get('Positive prompt', ''),
+                    'negative_prompt': prompt.get('Negative prompt', '')
+                } if prompt else None
+            } for idx, (scene, prompt) in enumerate(scene_entries)]
+        }
+        try:
+            write_atomic(file_path, [json.dumps(manifest, indent=2, ensure_ascii=False) + "\n"])
+            print(f"Manifest saved to {file_path}")
+            logging.info(f"Manifest saved to {file_path}")
+        except Exception as e:
+            logging.error(f"Error saving manifest to {file_path}: {e}")
+
+def write_run_index(output_dir, story_names):
+    # Concatenates the stories' prompts.jsonl into one queue-ready file for the whole run
+    file_path = os.path.join(output_dir, "index.jsonl")
+
+    def lines():
+        for story_name in story_names:
+            story_file = os.path.join(output_dir, story_name, "prompts.jsonl")
+            if os.path.exists(story_file):
+                with open(story_file, 'r', encoding="utf-8") as f:
+                    yield from f
+
+    try:
+        write_atomic(file_path, lines())
+        logging.info(f"Run index saved to {file_path}")
+        return file_path
+    except Exception as e:
+        logging.error(f"Error saving run index to {file_path}: {e}")
+        return None
+
+_journal_lock = threading.Lock()
+
+def append_journal(file_path, record):
+    try:
+        with _journal_lock:
+            with open(file_path, 'a', encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception as e:
+        logging.error(f"Error writing journal {file_path}: {e}")
+
+def load_journal(file_path):
+    # Later records supersede earlier ones: new characters invalidate the scenes and
+    # scene prompts recorded before them, and new scenes invalidate earlier prompts.
+    state = {'characters': None, 'scenes': None, 'scene_prompts': {}, 'done': False}
+    if not os.path.exists(file_path):
+        return state
+    try:
+        with open(file_path, 'r', encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-write leaves a torn last line; everything before it is valid
+                    logging.warning(f"Skipping corrupt journal line in {file_path}")
+                    continue
+                kind = record.get('type')
+                if kind == 'characters':
+                    state.update(characters=record, scenes=None, scene_prompts={}, done=False)
+                elif kind == 'scenes':
+                    # Streamed scenes are journaled after their prompts, so only a
+                    # replacement scene list invalidates the prompts seen so far
+                    if state['scenes'] is not None:
+                        state['scene_prompts'] = {}
+                    state.update(scenes=record, done=False)
+                elif kind == 'scene_prompt':
+                    state['scene_prompts'][record['index']] = record
+                elif kind == 'done':
+                    state['done'] = True
+    except Exception as e:
+        logging.error(f"Error reading journal {file_path}: {e}")
+    return state
+
+# Character registry shared across stories: recurring characters are recognised by
+# name, alias or a near-miss spelling and keep the description and positive prompt they
+# were first given, so a series stays visually consistent and known casts need no LLM
+# call. Lookups go through indexed tables of exact aliases, name tokens and trigrams.
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registry', 'characters.sqlite3')
+
+registry_settings = {
+    'path': None,
+    # Minimum trigram Dice similarity for two spellings to be the same character
+    'min_similarity': 0.75
+}
+
+_registry_conn = None
+_registry_lock = threading.Lock()
+
+def configure_registry(path=None, min_similarity=None):
+    global _registry_conn
+    if path is not None:
+        registry_settings['path'] = path
+    if min_similarity is not None:
+        registry_settings['min_similarity'] = min_similarity
+    with _registry_lock:
+        if _registry_conn is not None:
+            _registry_conn.close()
+            _registry_conn = None
+
+def get_registry_connection():
+    # Called with _registry_lock held
+    global _registry_conn
+    if _registry_conn is None:
+        os.makedirs(os.path.dirname(os.path.abspath(registry_settings['path'])), exist_ok=True)
+        conn = sqlite3.connect(registry_settings['path'], check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS characters ("
+            "id INTEGER PRIMARY KEY, name TEXT NOT NULL, data TEXT NOT NULL, positive_prompt TEXT NOT NULL, "
+            "first_story TEXT, stories INTEGER NOT NULL DEFAULT 1, updated REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, character_id INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS tokens (token TEXT NOT NULL, character_id INTEGER NOT NULL, "
+            "PRIMARY KEY (token, character_id));"
+            "CREATE TABLE IF NOT EXISTS grams (gram TEXT NOT NULL, character_id INTEGER NOT NULL, "
+            "PRIMARY KEY (gram, character_id));"
+        )
+        _registry_conn = conn
+    return _registry_conn
+
+def normalize_name(name):
+    tokens = re.findall(r"[\w']+", str(name).lower())
+    return " ".join(token for token in tokens if token not in NAME_TITLES) or " ".join(tokens)
+
+# Stand-ins for a missing name (parse_json_response_characters defaults to 'Unknown');
+# they are never registered or matched, or every nameless character would become one
+PLACEHOLDER_NAMES = {'', 'unknown', 'unnamed', 'none', 'n a'}
+
+def is_placeholder_name(name):
+    return normalize_name(name) in PLACEHOLDER_NAMES
+
+def name_trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[idx:idx + 3] for idx in range(len(padded) - 2)}
+
+def registry_entry(conn, character_id):
+    row = conn.execute("SELECT name, data, positive_prompt FROM characters WHERE id = ?", (character_id,)).fetchone()
+    return {'id': character_id, 'name': row[0], 'data': json.loads(row[1]), 'positive_prompt': row[2]}
+
+def registry_lookup(conn, name):
+    """Exact alias, then a unique token-subset match sharing at least two words ("Leon
+    Gabor" for "Dr. Leon Gabor Jr."), then the most similar spelling by trigram Dice
+    coefficient. A one-word name is common to many people ("John" is not "John Smith"),
+    so it only ever matches on spelling similarity over the whole name.
+    """
+    normalized = normalize_name(name)
+    if normalized in PLACEHOLDER_NAMES:
+        return None
+    tokens = set(normalized.split())
+    if len(tokens) > 1:
+        row = conn.execute("SELECT character_id FROM aliases WHERE alias = ?", (normalized,)).fetchone()
+        if row:
+            return row[0]
+
+    placeholders = ",".join("?" * len(tokens))
+    candidates = {}
+    for character_id, token in conn.execute(
+            f"SELECT character_id, token FROM tokens WHERE token IN ({placeholders})", tuple(tokens)):
+        candidates.setdefault(character_id, set()).add(token)
+    subset_matches = []
+    for character_id in candidates:
+        known = {token for (token,) in conn.execute("SELECT token FROM tokens WHERE character_id = ?", (character_id,))}
+        if len(tokens & known) >= 2 and (tokens <= known or known <= tokens):
+            subset_matches.append(character_id)
+    if len(subset_matches) == 1:
+        return subset_matches[0]
+
+    # The grams table finds the candidates; each of their spellings is scored on its own so
+    # that learning more aliases never dilutes the similarity of the closest one
+    grams = name_trigrams(normalized)
+    placeholders = ",".join("?" * len(grams))
+    best, best_score = None, 0.0
+    for (character_id,) in conn.execute(
+            f"SELECT DISTINCT character_id FROM grams WHERE gram IN ({placeholders})", tuple(grams)):
+        spellings = {alias for (alias,) in conn.execute("SELECT alias FROM aliases WHERE character_id = ?", (character_id,))}
+        spellings.add(normalize_name(conn.execute("SELECT name FROM characters WHERE id = ?", (character_id,)).fetchone()[0]))
+        for spelling in spellings:
+            other = name_trigrams(spelling)
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            if score > best_score:
+                best, best_score = character_id, score
+    return best if best_score >= registry_settings['min_similarity'] else None
+
+def index_registry_name(conn, character_id, name):
+    normalized = normalize_name(name)
+    # One-word aliases would claim every later mention of a common first name
+    if ' ' in normalized:
+        conn.execute("INSERT OR IGNORE INTO aliases (alias, character_id) VALUES (?, ?)", (normalized, character_id))
+    conn.executemany("INSERT OR IGNORE INTO tokens (token, character_id) VALUES (?, ?)",
+                     [(token, character_id) for token in normalized.split()])
+    conn.executemany("INSERT OR IGNORE INTO grams (gram, character_id) VALUES (?, ?)",
+                     [(gram, character_id) for gram in name_trigrams(normalized)])
+
+def find_registered_characters(voiceover_text, num_characters):
+    """Returns registered characters named in the voiceover, most mentioned first, or []
+    when fewer than num_characters are found and the model has to identify the cast."""
+    if not registry_settings['path']:
+        return []
+    text = voiceover_text.lower()
+    words = set(re.findall(r"[\w']+", text))
+    try:
+        with _registry_lock:
+            conn = get_registry_connection()
+            mentions = {}
+            for alias, character_id in conn.execute("SELECT alias, character_id FROM aliases"):
+                if alias in PLACEHOLDER_NAMES or ' ' not in alias or not set(alias.split()) <= words:
+                    continue
+                count = len(re.findall(r"\b" + re.escape(alias) + r"\b", text))
+                if count:
+                    first = text.find(alias)
+                    seen = mentions.get(character_id, (0, first))
+                    mentions[character_id] = (seen[0] + count, min(seen[1], first))
+            if len(mentions) < num_characters:
+                return []
+            chosen = sorted(mentions, key=lambda character_id: -mentions[character_id][0])[:num_characters]
+            chosen.sort(key=lambda character_id: mentions[character_id][1])
+            return [registry_entry(conn, character_id)['data'] for character_id in chosen]
+    except sqlite3.Error as e:
+        logging.error(f"Error reading character registry: {e}")
+        return []
+
+def register_characters(story_name, characters):
+    """Swaps characters the registry already knows for their registered version and adds
+    the new ones with their positive prompt. Returns (characters, number matched)."""
+    if not registry_settings['path']:
+        return characters, 0
+    resolved, matched, seen = [], 0, set()
+    try:
+        with _registry_lock:
+            conn = get_registry_connection()
+            for character in characters:
+                if is_placeholder_name(character['name']):
+                    resolved.append(character)
+                    continue
+                character_id = registry_lookup(conn, character['name'])
+                if character_id is None:
+                    positive_prompt = generate_character_prompts([character], '')[0]['Positive prompt']
+                    cursor = conn.execute(
+                        "INSERT INTO characters (name, data, positive_prompt, first_story, updated) VALUES (?, ?, ?, ?, ?)",
+                        (character['name'], json.dumps(character), positive_prompt, story_name, time.time())
+                    )
+                    index_registry_name(conn, cursor.lastrowid, character['name'])
+                    seen.add(cursor.lastrowid)
+                    resolved.append(character)
+                    continue
+                if character_id in seen:
+                    # Two names in this story resolved to one registered character
+                    continue
+                seen.add(character_id)
+                matched += 1
+                # Learn the spelling used here so later stories match it exactly
+                index_registry_name(conn, character_id, character['name'])
+                conn.execute("UPDATE characters SET stories = stories + 1, updated = ? WHERE id = ?", (time.time(), character_id))
+                resolved.append(registry_entry(conn, character_id)['data'])
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Error updating character registry: {e}")
+        return characters, 0
+    return resolved, matched
+
+def apply_registered_prompts(character_prompts):
+    # Registered characters keep the positive prompt they were first given
+    if not registry_settings['path']:
+        return character_prompts
+    try:
+        with _registry_lock:
+            conn = get_registry_connection()
+            prompts = []
+            for prompt in character_prompts:
+                if is_placeholder_name(prompt['Name']):
+                    prompts.append(prompt)
+                    continue
+                character_id = registry_lookup(conn, prompt['Name'])
+                row = conn.execute("SELECT positive_prompt FROM characters WHERE id = ?", (character_id,)).fetchone()
+                prompts.append(dict(prompt, **{'Positive prompt': row[0]}) if row else prompt)
+            return prompts
+    except sqlite3.Error as e:
+        logging.error(f"Error reading character registry: {e}")
+        return character_prompts
+
+# Incremental regeneration: output/<story>/state.json keeps each stage's result under a
+# hash of everything that stage depends on, so an edited voiceover or changed count
+# only redoes the stages whose inputs changed. Bump PROMPT_VERSION whenever a prompt
+# template changes, which invalidates every stored result.
+PROMPT_VERSION = 1
+
+def stage_key(stage, *inputs):
+    payload = json.dumps([PROMPT_VERSION, model_for(stage), stage, *inputs], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def scene_prompt_key(scene, characters, negative_prompt):
+    # Compaction changes what the model sees, so its settings are part of the key
+    if compaction_settings['enabled']:
+        return stage_key('scene_prompts', scene, characters, negative_prompt, compaction_settings)
+    return stage_key('scene_prompts', scene, characters, negative_prompt)
+
+def load_story_state(file_path):
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r', encoding="utf-8") as f:
+            state = json.load(f)
+    except Exception as e:
+        logging.error(f"Error reading story state {file_path}: {e}")
+        return {}
+    if not isinstance(state, dict) or state.get('prompt_version') != PROMPT_VERSION:
+        return {}
+    return state
+
+def save_story_state(file_path, state):
+    try:
+        write_atomic(file_path, [json.dumps(state, indent=2)])
+    except Exception as e:
+        logging.error(f"Error saving story state {file_path}: {e}")
+
+def process_story_auto(story_file, input_dir, output_dir, num_characters, num_scenes, concurrency=1,
+                       resume=False, show_progress=False, stream=False, batch_size=1, incremental=False):
+    story_name = os.path.splitext(story_file)[0]
+    story_output_dir = os.path.join(output_dir, story_name)
+    journal_file = os.path.join(story_output_dir, "journal.jsonl")
+    state_file = os.path.join(story_output_dir, "state.json")
+    state = {'prompt_version': PROMPT_VERSION}
+    summary = {
+        'story': story_name,
+        'status': 'ok',
+        'error': None,
+        'characters': 0,
+        'scenes': 0,
+        'scene_prompts': 0,
+        'resumed': False,
+        'reused': {'characters': 0, 'scenes': 0, 'scene_prompts': 0},
+        'registry': {'known_cast': False, 'matched': 0},
+        'timings': {}
+    }
+    story_start = time.perf_counter()
+    current_story.set(story_name)
+
+    try:
+        os.makedirs(story_output_dir, exist_ok=True)
+        voiceover_text = load_voiceover(os.path.join(input_dir, story_file))
+        if not voiceover_text:
+            raise RuntimeError("Empty or unreadable voiceover file")
+        logging.info(f"Processing story: {story_name}")
+
+        journal = load_journal(journal_file) if resume else None
+        if journal and journal['characters'] and journal['characters'].get('num_characters') != num_characters:
+            logging.info(f"Character count changed for {story_name}, ignoring its journal")
+            journal = None
+        if not resume or journal is None:
+            open(journal_file, 'w', encoding="utf-8").close()
+        if journal and journal['scenes'] and journal['scenes'].get('num_scenes') != num_scenes:
+            journal.update(scenes=None, scene_prompts={}, done=False)
+
+        if journal and journal['done']:
+            summary.update(
+                status='skipped',
+                resumed=True,
+                characters=len(journal['characters']['data']),
+                scenes=len(journal['scenes']['data']),
+                scene_prompts=len(journal['scene_prompts'])
+            )
+            logging.info(f"Story {story_name} already completed, skipping")
+            summary['timings']['total'] = round(time.perf_counter() - story_start, 3)
+            return summary
+
+        previous = load_story_state(state_file) if incremental else {}
+        characters_key = stage_key('characters', voiceover_text, num_characters)
+        scenes_key = stage_key('scenes', voiceover_text)
+
+        stage_start = time.perf_counter()
+        if journal and journal['characters']:
+            characters = journal['characters']['data']
+            summary['resumed'] = True
+        elif previous.get('characters', {}).get('key') == characters_key:
+            characters = previous['characters']['data']
+            summary['reused']['characters'] = len(characters)
+            append_journal(journal_file, {'type': 'characters', 'num_characters': num_characters, 'data': characters})
+        else:
+            characters = find_registered_characters(voiceover_text, num_characters)
+            if characters:
+                summary['registry']['known_cast'] = True
+            elif stream:
+                characters = list(stream_characters(voiceover_text, num_characters))
+            else:
+                characters = identify_characters(voiceover_text, num_characters)
+            characters, summary['registry']['matched'] = register_characters(story_name, characters)
+            if characters:
+                append_journal(journal_file, {'type': 'characters', 'num_characters': num_characters, 'data': characters})
+        summary['timings']['characters'] = round(time.perf_counter() - stage_start, 3)
+        if not characters:
+            raise RuntimeError("No characters identified")
+        summary['characters'] = len(characters)
+        state['characters'] = {'key': characters_key, 'data': characters}
+
+        negative_prompt = generate_negative_prompt()
+        character_prompts = apply_registered_prompts(generate_character_prompts(characters, negative_prompt))
+        if 'text' in output_settings['formats']:
+            save_prompts(character_prompts, os.path.join(story_output_dir, f"characters_{story_name}.txt"))
+
+        stage_start = time.perf_counter()
+        if journal and journal['scenes']:
+            scenes = journal['scenes']['data']
+            scene_source = scenes
+        elif previous.get('scenes', {}).get('key') == scenes_key:
+            # Same voiceover: keep the earlier scenes and only ask for any extra ones
+            scenes = previous['scenes']['data'][:num_scenes]
+            summary['reused']['scenes'] = len(scenes)
+            if len(scenes) < num_scenes:
+                scenes = scenes + extend_scenes(voiceover_text, scenes, num_scenes)
+            append_journal(journal_file, {'type': 'scenes', 'num_scenes': num_scenes, 'data': scenes})
+            summary['timings']['scenes'] = round(time.perf_counter() - stage_start, 3)
+            scene_source = scenes
+        elif stream:
+            # Scene prompting starts on each scene as soon as it has been streamed
+            scenes = []
+
+            def scene_source_stream():
+                for scene in stream_scenes(voiceover_text, num_scenes):
+                    scenes.append(scene)
+                    yield scene
+                summary['timings']['scenes'] = round(time.perf_counter() - stage_start, 3)
+
+            scene_source = scene_source_stream()
+        else:
+            scenes = suggest_scenes(voiceover_text, num_scenes)
+            if scenes:
+                append_journal(journal_file, {'type': 'scenes', 'num_scenes': num_scenes, 'data': scenes})
+            summary['timings']['scenes'] = round(time.perf_counter() - stage_start, 3)
+            if not scenes:
+                raise RuntimeError("No scenes generated")
+            scene_source = scenes
+
+        completed = dict(journal['scene_prompts']) if journal else {}
+        previous_prompts = previous.get('scene_prompts', {})
+        if previous_prompts and scene_source is scenes:
+            for idx, scene in enumerate(scenes):
+                prompt = previous_prompts.get(scene_prompt_key(scene, characters, negative_prompt))
+                if prompt and idx not in completed:
+                    completed[idx] = {'type': 'scene_prompt', 'index': idx, 'scene': scene['Scene'], 'data': prompt}
+                    # Journaled like fresh prompts so a later --resume sees them
+                    append_journal(journal_file, completed[idx])
+                    summary['reused']['scene_prompts'] += 1
+        kept_prompts = {}
+        prompts_by_index = {}
+
+        def keep_prompt(idx, scene, prompt):
+            kept_prompts[scene_prompt_key(scene, characters, negative_prompt)] = prompt
+            prompts_by_index[idx] = prompt
+
+        stage_start = time.perf_counter()
+        scene_prompts = generate_scene_prompts(
+            scene_source, characters, negative_prompt, concurrency, show_progress=show_progress,
+            completed=completed, journal_file=journal_file, batch_size=batch_size,
+            on_prompt=keep_prompt
+        )
+        summary['timings']['scene_prompts'] = round(time.perf_counter() - stage_start, 3)
+        if stream and scene_source is not scenes:
+            if not scenes:
+                raise RuntimeError("No scenes generated")
+            append_journal(journal_file, {'type': 'scenes', 'num_scenes': num_scenes, 'data': scenes})
+        summary['scenes'] = len(scenes)
+        summary['scene_prompts'] = len(scene_prompts)
+        state['scenes'] = {'key': scenes_key, 'data': scenes}
+        state['scene_prompts'] = kept_prompts
+        if not scene_prompts:
+            logging.warning(f"No scene prompts generated for {story_name}.")
+        elif 'text' in output_settings['formats']:
+            save_prompts(scene_prompts, os.path.join(story_output_dir, f"scenes_{story_name}.txt"))
+        if len(scene_prompts) < len(scenes):
+            summary['status'] = 'partial'
+            summary['error'] = f"{len(scenes) - len(scene_prompts)} scene prompt(s) failed"
+
+        if 'text' in output_settings['formats']:
+            save_chosen_images(scenes, os.path.join(story_output_dir, "chosen_images.txt"))
+        save_story_outputs(story_name, story_output_dir, character_prompts,
+                           [(scene, prompts_by_index.get(idx)) for idx, scene in enumerate(scenes)])
+        if summary['status'] == 'ok':
+            append_journal(journal_file, {'type': 'done'})
+    except Exception as e:
+        summary['status'] = 'failed'
+        summary['error'] = str(e)
+        logging.error(f"Story {story_name} failed: {e}")
+
+    if incremental and len(state) > 1:
+        save_story_state(state_file, state)
+    summary['timings']['total'] = round(time.perf_counter() - story_start, 3)
+    return summary
+
+def run_batch(stories, input_dir, output_dir, num_characters, num_scenes, jobs=1, concurrency=1, resume=False,
+              stream=False, batch_size=1, story_counts=None, incremental=False):
+    # Each worker carries one story through all three stages, so stages of different
+    # stories overlap; llm_slots keeps the total number of model calls bounded.
+    # story_counts maps a story file to its own (num_characters, num_scenes).
+    story_counts = story_counts or {}
+    summaries = []
+    batch_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(process_story_auto, story_file, input_dir, output_dir,
+                            *story_counts.get(story_file, (num_characters, num_scenes)),
+                            concurrency, resume, show_progress=(jobs == 1), stream=stream,
+                            batch_size=batch_size, incremental=incremental)
+            for story_file in stories
+        ]
+        for future in progress_bar(as_completed(futures), total=len(futures), desc="Processing stories", disable=(jobs == 1)):
+            summary = future.result()
+            record_story(summary)
+            summaries.append(summary)
+
+    summaries.sort(key=lambda summary: summary['story'])
+    index_path = None
+    if 'jsonl' in output_settings['formats']:
+        index_path = write_run_index(output_dir, [summary['story'] for summary in summaries])
+    report = {
+        'jobs': jobs,
+        'stories': len(summaries),
+        'failed': sum(1 for summary in summaries if summary['status'] == 'failed'),
+        'wall_time': round(time.perf_counter() - batch_start, 3),
+        'tokens': dict(token_stats),
+        'compaction': dict(compaction_stats),
+        'metrics': summarize_metrics(),
+        'endpoints': endpoint_stats() if ollama_settings['backend'] == 'http' else [],
+        'index': index_path,
+        'results': summaries
+    }
+    summary_path = os.path.join(output_dir, "batch_summary.json")
+    try:
+        write_atomic(summary_path, [json.dumps(report, indent=2)])
+        logging.info(f"Batch summary saved to {summary_path}")
+    except Exception as e:
+        logging.error(f"Error saving batch summary to {summary_path}: {e}")
+
+    print(f"\n{'Story':<40} {'Status':<8} {'Chars':>5} {'Scenes':>6} {'Prompts':>7} {'Time (s)':>9}")
+    for summary in summaries:
+        print(f"{summary['story'][:40]:<40} {summary['status']:<8} {summary['characters']:>5} "
+              f"{summary['scenes']:>6} {summary['scene_prompts']:>7} {summary['timings']['total']:>9.1f}")
+        if summary['error']:
+            print(f"    {summary['error']}")
+    if token_stats['prompt_tokens']:
+        print(f"\nPrompt tokens: {token_stats['prompt_tokens']} sent, {token_stats['prompt_eval_tokens']} evaluated, "
+              f"{token_stats['prompt_eval_saved']} served from Ollama's prompt cache")
+    print_compaction_summary()
+    print_metrics_summary(report['metrics'])
+    if len(report['endpoints']) > 1:
+        print(f"\n{'Endpoint':<40} {'Calls':>6} {'Errors':>6} Healthy")
+        for endpoint in report['endpoints']:
+            print(f"{endpoint['host'][:40]:<40} {endpoint['calls']:>6} {endpoint['errors']:>6} "
+                  f"{'yes' if endpoint['healthy'] else 'no'}")
+    if metrics_settings['prometheus_file']:
+        write_prometheus(metrics_settings['prometheus_file'], report['metrics'], summaries)
+    close_trace()
+    print(f"\n{report['stories']} stories in {report['wall_time']:.1f}s, {report['failed']} failed. Summary saved to {summary_path}")
+    return report
+
+# Headless runs: a manifest lists the stories and their counts, so nothing is asked
+# on stdin and the keyboard listener is never started
+EXIT_OK = 0
+EXIT_STORIES_FAILED = 1
+EXIT_BAD_MANIFEST = 2
+
+MANIFEST_KEYS = {'model', 'stage_models', 'stage_timeouts', 'endpoints', 'input_dir', 'output_dir', 'characters', 'scenes', 'jobs', 'concurrency',
+                 'batch_size', 'stream', 'resume', 'incremental', 'output_formats', 'character_registry',
+                 'compact_characters', 'scene_token_budget', 'stories'}
+
+class ManifestError(Exception):
+    pass
+
+def manifest_count(entry, key, default, where):
+    value = entry.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ManifestError(f"{where}: '{key}' must be a positive integer, got {value!r}")
+    return value
+
+def load_manifest(file_path):
+    """Reads a JSON or YAML job manifest and returns it validated and with defaults applied.
+
+    Top-level keys: model, stage_models (stage name to model), stage_timeouts (stage name
+    to a deadline in seconds), endpoints (Ollama URLs to
+    balance over), input_dir, output_dir (relative to the manifest), characters and
+    scenes (defaults for every story), jobs, concurrency, batch_size, stream, resume, incremental,
+    output_formats (any of text, jsonl, manifest), character_registry (a path relative to the
+    manifest, or true for the default), compact_characters, scene_token_budget (tokens per
+    scene prompt request; implies compact_characters) and
+    stories: a list of file names or {file, characters, scenes} mappings. Without a stories
+    list every .txt file in input_dir is processed with the defaults.
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except OSError as e:
+        raise ManifestError(f"Cannot read manifest {file_path}: {e}")
+
+    if file_path.lower().endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ManifestError("YAML manifests need PyYAML (pip install pyyaml); use a .json manifest instead")
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ManifestError(f"Invalid YAML in {file_path}: {e}")
+    else:
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ManifestError(f"Invalid JSON in {file_path}: {e}")
+
+    if not isinstance(data, dict):
+        raise ManifestError(f"{file_path}: the manifest must be a mapping")
+    unknown = set(data) - MANIFEST_KEYS
+    if unknown:
+        raise ManifestError(f"{file_path}: unknown key(s) {', '.join(sorted(unknown))}")
+
+    base_dir = os.path.dirname(os.path.abspath(file_path))
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    manifest = {
+        'model': data.get('model'),
+        'input_dir': os.path.join(base_dir, data['input_dir']) if data.get('input_dir') else os.path.join(script_dir, 'input'),
+        'output_dir': os.path.join(base_dir, data['output_dir']) if data.get('output_dir') else os.path.join(script_dir, 'output'),
+        'stream': bool(data.get('stream', False)),
+        'resume': bool(data.get('resume', False)),
+        'incremental': bool(data.get('incremental', False)),
+        'compact_characters': bool(data.get('compact_characters', False)),
+        'stories': []
+    }
+    if manifest['model'] is not None and not isinstance(manifest['model'], str):
+        raise ManifestError(f"{file_path}: 'model' must be a string")
+    manifest['stage_models'] = data.get('stage_models') or {}
+    if not isinstance(manifest['stage_models'], dict) or not all(
+            stage in STAGES and isinstance(model, str) for stage, model in manifest['stage_models'].items()):
+        raise ManifestError(f"{file_path}: 'stage_models' must map {', '.join(STAGES)} to model names")
+    manifest['stage_timeouts'] = data.get('stage_timeouts') or {}
+    if not isinstance(manifest['stage_timeouts'], dict) or not all(
+            stage in STAGES and isinstance(timeout, (int, float)) and not isinstance(timeout, bool) and timeout > 0
+            for stage, timeout in manifest['stage_timeouts'].items()):
+        raise ManifestError(f"{file_path}: 'stage_timeouts' must map {', '.join(STAGES)} to positive seconds")
+    manifest['output_formats'] = data.get('output_formats')
+    if manifest['output_formats'] is not None and (
+            not isinstance(manifest['output_formats'], list) or not manifest['output_formats']
+            or not set(manifest['output_formats']) <= set(OUTPUT_FORMATS)):
+        raise ManifestError(f"{file_path}: 'output_formats' must be a list of {', '.join(OUTPUT_FORMATS)}")
+    registry = data.get('character_registry')
+    if registry is True:
+        manifest['character_registry'] = DEFAULT_REGISTRY_PATH
+    elif isinstance(registry, str):
+        manifest['character_registry'] = os.path.join(base_dir, registry)
+    elif registry in (None, False):
+        manifest['character_registry'] = None
+    else:
+        raise ManifestError(f"{file_path}: 'character_registry' must be a path or true")
+    manifest['endpoints'] = data.get('endpoints') or []
+    if not isinstance(manifest['endpoints'], list) or not all(isinstance(url, str) for url in manifest['endpoints']):
+        raise ManifestError(f"{file_path}: 'endpoints' must be a list of URLs")
+    for key in ('jobs', 'concurrency', 'batch_size', 'scene_token_budget'):
+        manifest[key] = manifest_count(data, key, None, file_path) if key in data else None
+    default_characters = manifest_count(data, 'characters', 3, file_path)
+    default_scenes = manifest_count(data, 'scenes', 10, file_path)
+
+    if not os.path.isdir(manifest['input_dir']):
+        raise ManifestError(f"Input directory {manifest['input_dir']} does not exist")
+    entries = data.get('stories')
+    if entries is None:
+        entries = sorted(f for f in os.listdir(manifest['input_dir']) if f.endswith('.txt'))
+    if not isinstance(entries, list) or not entries:
+        raise ManifestError(f"{file_path}: no stories to process")
+
+    seen = set()
+    for idx, entry in enumerate(entries, 1):
+        where = f"{file_path}: story {idx}"
+        if isinstance(entry, str):
+            entry = {'file': entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get('file'), str):
+            raise ManifestError(f"{where}: expected a file name or a mapping with 'file'")
+        story_file = entry['file']
+        if story_file in seen:
+            raise ManifestError(f"{where}: {story_file} is listed twice")
+        if not os.path.isfile(os.path.join(manifest['input_dir'], story_file)):
+            raise ManifestError(f"{where}: {story_file} not found in {manifest['input_dir']}")
+        seen.add(story_file)
+        manifest['stories'].append({
+            'file': story_file,
+            'characters': manifest_count(entry, 'characters', default_characters, where),
+            'scenes': manifest_count(entry, 'scenes', default_scenes, where)
+        })
+    return manifest
+
+def run_manifest(manifest_file, args):
+    # Returns the process exit code instead of exiting so it can also be driven from Python
+    try:
+        manifest = load_manifest(manifest_file)
+    except ManifestError as e:
+        logging.error(str(e))
+        print(f"Manifest error: {e}", file=sys.stderr)
+        return EXIT_BAD_MANIFEST
+
+    jobs = manifest['jobs'] or args.jobs
+    concurrency = manifest['concurrency'] or args.concurrency
+    configure_ollama(
+        model=manifest['model'],
+        stage_models=dict(ollama_settings['stage_models'], **manifest['stage_models']),
+        stage_timeouts=dict(ollama_settings['stage_timeouts'], **manifest['stage_timeouts']),
+        endpoints=manifest['endpoints'] or None
+    )
+    set_max_inflight(args.max_inflight or max(jobs, concurrency), args.adaptive_concurrency)
+    configure_output(formats=manifest['output_formats'])
+    configure_registry(path=manifest['character_registry'])
+    if manifest['compact_characters'] or manifest['scene_token_budget']:
+        configure_compaction(enabled=True, token_budget=manifest['scene_token_budget'])
+
+    output_dir = manifest['output_dir']
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except OSError as e:
+        logging.error(f"Error creating output directory {output_dir}: {e}")
+        print(f"Failed to create output directory: {output_dir}", file=sys.stderr)
+        return EXIT_BAD_MANIFEST
+    configure_metrics(
+        trace_file=args.trace or os.path.join(output_dir, 'trace.jsonl'),
+        prometheus_file=args.prometheus,
+        log_payloads=args.log_payloads
+    )
+
+    stories = [story['file'] for story in manifest['stories']]
+    story_counts = {story['file']: (story['characters'], story['scenes']) for story in manifest['stories']}
+    first = manifest['stories'][0]
+    report = run_batch(
+        stories, manifest['input_dir'], output_dir, first['characters'], first['scenes'], jobs, concurrency,
+        manifest['resume'] or args.resume, manifest['stream'] or args.stream,
+        manifest['batch_size'] or args.batch_size, story_counts=story_counts,
+        incremental=manifest['incremental'] or args.incremental
+    )
+    if any(result['status'] in ('failed', 'partial') for result in report['results']):
+        return EXIT_STORIES_FAILED
+    return EXIT_OK
+
 def main():
+    _main_start = time.perf_counter()
     parser = argparse.ArgumentParser(description='Visual Storytelling Prompt Generation Tool')
     parser.add_argument('--auto', action='store_true', help='Run in automatic mode')
+    parser.add_argument('--manifest',
+                        help='Run headless from a JSON/YAML job manifest; never prompts. Exit status: '
+                             '0 all stories ok, 1 some stories failed or partial, 2 invalid manifest')
+    parser.add_argument('--backend', choices=['http', 'cli'], help="Ollama backend: local HTTP API (default) or 'ollama run' subprocess")
+    parser.add_argument('--ollama-host', help='Ollama server URL (default: $OLLAMA_HOST or http://localhost:11434)')
+    parser.add_argument('--model', help='Ollama model name (default: mistral-nemo)')
+    parser.add_argument('--endpoint', action='append', default=[], metavar='URL[=MODEL,...]',
+                        help='Ollama server to balance requests over; repeat for several servers. Append '
+                             '=model1,model2 to limit the models it serves (default: just --ollama-host)')
+    parser.add_argument('--stage-model', action='append', default=[], metavar='STAGE=MODEL',
+                        help=f"Model for one stage ({', '.join(STAGES)}), e.g. scene_prompts=llama3.2:3b; repeatable")
+    parser.add_argument('--keep-alive', help="How long Ollama keeps the model loaded between calls (default: 30m)")
+    parser.add_argument('--timeout', type=float, help='Per-request timeout in seconds (default: 600)')
+    parser.add_argument('--retries', type=int,
+                        help='Retries per backend, with jittered exponential backoff, before falling back to the CLI (default: 2)')
+    parser.add_argument('--stage-timeout', action='append', default=[], metavar='STAGE=SECONDS',
+                        help=f"Overall deadline for one call of a stage ({', '.join(STAGES)}) including retries; repeatable")
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('OLLAMA_NUM_PARALLEL', 1)),
+                        help='Scene prompts generated in parallel (default: $OLLAMA_NUM_PARALLEL or 1)')
+    parser.add_argument('--jobs', type=int, default=1, help='Stories processed in parallel in automatic mode (default: 1)')
+    parser.add_argument('--max-inflight', type=int,
+                        help='Global cap on concurrent LLM calls (default: the larger of --jobs and --concurrency)')
+    parser.add_argument('--adaptive-concurrency', action='store_true',
+                        help='Lower the in-flight limit when LLM latency climbs and raise it back as it recovers')
+    parser.add_argument('--no-cache', action='store_true', help='Always query the model instead of reusing cached responses')
+    parser.add_argument('--cache-dir', help='Directory for the LLM response cache (default: ./cache next to this script)')
+    parser.add_argument('--cache-max-mb', type=int, help='Response cache size limit in MB before LRU eviction (default: 256)')
+    parser.add_argument('--resume', action='store_true',
+                        help='In automatic mode, reuse work recorded in each story\'s journal.jsonl and skip finished stories')
+    parser.add_argument('--incremental', action='store_true',
+                        help="In automatic mode, keep each stage's results in output/<story>/state.json and redo only "
+                             "the stages whose inputs (voiceover, counts, model, prompt version) changed")
+    parser.add_argument('--chunk-size', type=int,
+                        help='Split voiceovers longer than this many characters into chunks that are processed in '
+                             'parallel and merged (default: off)')
+    parser.add_argument('--chunk-overlap', type=int, help='Characters repeated between neighbouring chunks (default: 400)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream model output and start scene prompts while scenes are still being generated')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Scenes per scene-prompt request; missing results are retried per scene (default: 1)')
+    parser.add_argument('--reuse-context', action='store_true',
+                        help="Evaluate each story's shared prompt prefix once and continue later calls from Ollama's context")
+    parser.add_argument('--output-format', default='text',
+                        help=f"Comma-separated output formats: {', '.join(OUTPUT_FORMATS)}. jsonl also writes a "
+                             "run-level output/index.jsonl (default: text)")
+    parser.add_argument('--character-registry', nargs='?', const=DEFAULT_REGISTRY_PATH, metavar='PATH',
+                        help='Reuse recurring characters and their prompts across stories from this registry '
+                             '(default when given without a path: ./registry/characters.sqlite3 next to this script)')
+    parser.add_argument('--compact-characters', action='store_true',
+                        help='Send each scene prompt request only the characters its scene mentions, one line each')
+    parser.add_argument('--scene-token-budget', type=int, metavar='TOKENS',
+                        help='Estimated token budget per scene prompt request; the character sheet is shortened '
+                             'to fit (implies --compact-characters)')
+    parser.add_argument('--trace', help='JSONL trace of every LLM call, parse failure and stage (default: output/trace.jsonl)')
+    parser.add_argument('--prometheus', help='Also write run metrics to this Prometheus textfile-collector file')
+    parser.add_argument('--log-payloads', action='store_true', help='Log full prompts and responses to script.log')
+    parser.add_argument('--no-json-schema', action='store_true',
+                        help="Do not send JSON schemas as Ollama's structured-output format (for servers older than 0.5)")
+    parser.add_argument('--log-file', default='script.log', help='Debug log file (default: script.log in the working directory)')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print import, module load, argument parsing and lazy import times to stderr on exit')
+    parser.add_argument('--no-cli-fallback', action='store_true', help="Do not fall back to 'ollama run' when the HTTP backend fails")
     args = parser.parse_args()
+    startup_timings = {
+        'standard library imports': _stdlib_imported - _module_load_start,
+        'module load (total)': _module_loaded - _module_load_start,
+        'argument parsing': time.perf_counter() - _main_start
+    }
+    if args.profile_startup:
+        atexit.register(print_startup_profile, startup_timings)
+    setup_logging(args.log_file)
+
+    stage_models = {}
+    for spec in args.stage_model:
+        stage, _, model = spec.partition('=')
+        if stage not in STAGES or not model:
+            parser.error(f"--stage-model expects STAGE=MODEL with STAGE one of {', '.join(STAGES)}, got {spec!r}")
+        stage_models[stage] = model
+    output_formats = [fmt.strip() for fmt in args.output_format.split(',') if fmt.strip()]
+    if not output_formats or not set(output_formats) <= set(OUTPUT_FORMATS):
+        parser.error(f"--output-format expects a comma-separated list of {', '.join(OUTPUT_FORMATS)}")
+    configure_output(formats=output_formats)
+    stage_timeouts = {}
+    for spec in args.stage_timeout:
+        stage, _, seconds = spec.partition('=')
+        try:
+            stage_timeouts[stage] = float(seconds)
+        except ValueError:
+            stage = None
+        if stage not in STAGES or stage_timeouts[stage] <= 0:
+            parser.error(f"--stage-timeout expects STAGE=SECONDS with STAGE one of {', '.join(STAGES)}, got {spec!r}")
+
+    configure_ollama(
+        backend=args.backend,
+        host=args.ollama_host,
+        model=args.model,
+        keep_alive=args.keep_alive,
+        timeout=args.timeout,
+        retries=args.retries,
+        cli_fallback=False if args.no_cli_fallback else None,
+        reuse_context=True if args.reuse_context else None,
+        structured_output=False if args.no_json_schema else None,
+        endpoints=args.endpoint or None,
+        stage_models=stage_models or None,
+        stage_timeouts=stage_timeouts or None
+    )
+    configure_chunking(size=args.chunk_size, overlap=args.chunk_overlap)
+    configure_registry(path=args.character_registry)
+    if args.scene_token_budget is not None and args.scene_token_budget < 1:
+        parser.error("--scene-token-budget must be a positive number of tokens")
+    if args.compact_characters or args.scene_token_budget:
+        configure_compaction(enabled=True, token_budget=args.scene_token_budget)
+    configure_cache(
+        enabled=False if args.no_cache else None,
+        cache_dir=args.cache_dir,
+        max_bytes=args.cache_max_mb * 1024 * 1024 if args.cache_max_mb is not None else None
+    )
+    if args.manifest:
+        sys.exit(run_manifest(args.manifest, args))
+    set_max_inflight(args.max_inflight or max(args.jobs, args.concurrency), args.adaptive_concurrency)
 
     listener = start_keyboard_listener()
 
@@ -370,6 +2951,12 @@ def main():
         print(f"Failed to create output directory: {output_dir}")
         sys.exit(1)
 
+    configure_metrics(
+        trace_file=args.trace or os.path.join(output_dir, 'trace.jsonl'),
+        prometheus_file=args.prometheus,
+        log_payloads=args.log_payloads
+    )
+
     stories = [f for f in os.listdir(input_dir) if f.endswith('.txt')]
 
     if not stories:
@@ -396,9 +2983,11 @@ def main():
             print("Please enter a valid number.")
             sys.exit(1)
         num_scenes = int(num_scenes_input)
-    else:
-        num_characters = None
-        num_scenes = None
+
+        run_batch(stories, input_dir, output_dir, num_characters, num_scenes, args.jobs, args.concurrency, args.resume,
+                  args.stream, args.batch_size, incremental=args.incremental)
+        listener.stop()
+        return
 
     for story_file in stories:
         story_name = os.path.splitext(story_file)[0]
@@ -416,12 +3005,11 @@ def main():
         print(f"\nProcessing story: {story_name}")
         logging.info(f"Processing story: {story_name}")
 
-        if not args.auto:
-            num_characters_input = input("\nEnter the number of main characters you want for this story: ").strip()
-            if not num_characters_input.isdigit():
-                print("Please enter a valid number.")
-                continue
-            num_characters = int(num_characters_input)
+        num_characters_input = input("\nEnter the number of main characters you want for this story: ").strip()
+        if not num_characters_input.isdigit():
+            print("Please enter a valid number.")
+            continue
+        num_characters = int(num_characters_input)
 
         characters = identify_characters(voiceover_text, num_characters)
 
@@ -430,48 +3018,48 @@ def main():
             logging.warning("No characters identified.")
             continue
 
-        if not args.auto:
-            print("\nIdentified Characters:")
-            for idx, char in enumerate(characters):
-                print(f"{idx + 1}. {char['name']} (Age: {char['age']}, Role: {char['role']})")
-                print(f"   Description: {char['description']}")
-                print(f"   Clothing: {char['clothing']}")
-
-            if enable_editing:
-                edit_choice = input("\nWould you like to edit any characters? (yes/no): ").strip().lower()
-                if edit_choice == 'yes':
-                    while True:
-                        char_num = input("Enter character number to edit (or 'done' to finish): ").strip()
-                        if char_num.lower() == 'done':
-                            break
-                        try:
-                            idx = int(char_num) - 1
-                            if 0 <= idx < len(characters):
-                                characters[idx] = edit_character(characters[idx])
-                            else:
-                                print("Invalid character number.")
-                        except ValueError:
-                            print("Please enter a valid number.")
-
-            selected = input("\nEnter the numbers of the characters you want to include (e.g., 1,3): ").strip()
-            selected_indices = [int(i)-1 for i in selected.split(',') if i.strip().isdigit()]
-            characters = [characters[i] for i in selected_indices if 0 <= i < len(characters)]
+        print("\nIdentified Characters:")
+        for idx, char in enumerate(characters):
+            print(f"{idx + 1}. {char['name']} (Age: {char['age']}, Role: {char['role']})")
+            print(f"   Description: {char['description']}")
+            print(f"   Clothing: {char['clothing']}")
+
+        if enable_editing:
+            edit_choice = input("\nWould you like to edit any characters? (yes/no): ").strip().lower()
+            if edit_choice == 'yes':
+                while True:
+                    char_num = input("Enter character number to edit (or 'done' to finish): ").strip()
+                    if char_num.lower() == 'done':
+                        break
+                    try:
+                        idx = int(char_num) - 1
+                        if 0 <= idx < len(characters):
+                            characters[idx] = edit_character(characters[idx])
+                        else:
+                            print("Invalid character number.")
+                    except ValueError:
+                        print("Please enter a valid number.")
+
+        selected = input("\nEnter the numbers of the characters you want to include (e.g., 1,3): ").strip()
+        selected_indices = [int(i)-1 for i in selected.split(',') if i.strip().isdigit()]
+        characters = [characters[i] for i in selected_indices if 0 <= i < len(characters)]
 
         negative_prompt = generate_negative_prompt()
 
         character_prompts = generate_character_prompts(characters, negative_prompt)
-        save_prompts(character_prompts, os.path.join(story_output_dir, f"characters_{story_name}.txt"))
+        if 'text' in output_settings['formats']:
+            save_prompts(character_prompts, os.path.join(story_output_dir, f"characters_{story_name}.txt"))
 
         more_images = True
         total_scenes = []
+        scene_entries = []
 
         while more_images:
-            if not args.auto:
-                num_scenes_input = input("\nEnter the number of scenes you want to generate: ").strip()
-                if not num_scenes_input.isdigit():
-                    print("Please enter a valid number.")
-                    continue
-                num_scenes = int(num_scenes_input)
+            num_scenes_input = input("\nEnter the number of scenes you want to generate: ").strip()
+            if not num_scenes_input.isdigit():
+                print("Please enter a valid number.")
+                continue
+            num_scenes = int(num_scenes_input)
 
             scenes = suggest_scenes(voiceover_text, num_scenes)
 
@@ -480,44 +3068,45 @@ def main():
                 logging.warning("No scenes generated.")
                 break
 
-            if not args.auto:
-                print("\nProposed Scenes:")
-                for idx, scene in enumerate(scenes):
-                    print(f"{idx + 1}. {scene['Voiceover']}")
-                    print(f"   Description: {scene['Description']}")
-                selected = input("\nEnter the numbers of the scenes you want to include (e.g., 1,3): ").strip()
-                selected_indices = [int(i)-1 for i in selected.split(',') if i.strip().isdigit()]
-                selected_scenes = [scenes[i] for i in selected_indices if 0 <= i < len(scenes)]
-            else:
-                selected_scenes = scenes
+            print("\nProposed Scenes:")
+            for idx, scene in enumerate(scenes):
+                print(f"{idx + 1}. {scene['Voiceover']}")
+                print(f"   Description: {scene['Description']}")
+            selected = input("\nEnter the numbers of the scenes you want to include (e.g., 1,3): ").strip()
+            selected_indices = [int(i)-1 for i in selected.split(',') if i.strip().isdigit()]
+            selected_scenes = [scenes[i] for i in selected_indices if 0 <= i < len(scenes)]
 
-            scene_prompts = generate_scene_prompts(selected_scenes, characters, negative_prompt)
-            if scene_prompts:
-                save_prompts(scene_prompts, os.path.join(story_output_dir, f"scenes_{story_name}.txt"))
-            else:
+            round_prompts = {}
+            scene_prompts = generate_scene_prompts(selected_scenes, characters, negative_prompt, args.concurrency,
+                                                   batch_size=args.batch_size,
+                                                   on_prompt=lambda idx, scene, prompt: round_prompts.update({idx: prompt}))
+            if not scene_prompts:
                 logging.warning("No scene prompts generated.")
+            elif 'text' in output_settings['formats']:
+                save_prompts(scene_prompts, os.path.join(story_output_dir, f"scenes_{story_name}.txt"))
+            scene_entries.extend((scene, round_prompts.get(idx)) for idx, scene in enumerate(selected_scenes))
 
             total_scenes.extend(selected_scenes)
 
-            if not args.auto:
-                more = input("Do you want to generate more scenes? (yes/no): ").strip().lower()
-                if more != 'yes':
-                    more_images = False
-            else:
-                more_images = False  # In auto mode, we do not loop for more scenes
+            more = input("Do you want to generate more scenes? (yes/no): ").strip().lower()
+            if more != 'yes':
+                more_images = False
 
-        chosen_images_path = os.path.join(story_output_dir, "chosen_images.txt")
-        try:
-            with open(chosen_images_path, 'w', encoding="utf-8") as f:
-                for scene in total_scenes:
-                    f.write(f'Name: {scene["Scene"]}\nVoiceover: "{scene["Voiceover"]}"\n---\n')
-            print(f"Chosen images saved to {chosen_images_path}")
-            logging.info(f"Chosen images saved to {chosen_images_path}")
-        except Exception as e:
-            logging.error(f"Error saving chosen images to {chosen_images_path}: {e}")
+        if 'text' in output_settings['formats']:
+            save_chosen_images(total_scenes, os.path.join(story_output_dir, "chosen_images.txt"))
+        save_story_outputs(story_name, story_output_dir, character_prompts, scene_entries)
+
+    stages = summarize_metrics()
+    print_compaction_summary()
+    print_metrics_summary(stages)
+    if metrics_settings['prometheus_file']:
+        write_prometheus(metrics_settings['prometheus_file'], stages)
+    close_trace()
 
     # Stop keyboard listener
     listener.stop()
 
+_module_loaded = time.perf_counter()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import os
+import sys
+import copy
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+class StubOllama:
+    """Minimal stand-in for Ollama's /api/generate on a local port.
+
+    Replies are taken from self.replies in order: an int is sent as that HTTP status,
+    a string as the completion and bytes as a raw NDJSON stream body; once they run out,
+    default is answered. Every request is recorded with its JSON body and the client
+    port it arrived on.
+    """
+
+    def __init__(self, default="OK"):
+        self.default = default
+        self.replies = []
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub.lock:
+                    stub.requests.append({'path': self.path, 'body': body, 'port': self.client_address[1]})
+                    reply = stub.replies.pop(0) if stub.replies else stub.default
+                if isinstance(reply, int):
+                    out = b'{"error": "stub failure"}'
+                    self.send_response(reply)
+                elif isinstance(reply, bytes):
+                    out = reply
+                    self.send_response(200)
+                else:
+                    out = json.dumps({'response': reply, 'done': True}).encode('utf-8')
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def ollama_defaults():
+    # Tests reconfigure the module-level settings; put them back afterwards
+    saved = copy.deepcopy(main.ollama_settings)
+    saved_cache = dict(main.cache_settings)
+    main.configure_cache(enabled=False)
+    main.configure_ollama(retry_backoff=0.0)
+    yield main.ollama_settings
+    main.ollama_settings.clear()
+    main.ollama_settings.update(saved)
+    main.configure_ollama()
+    main.configure_cache(enabled=saved_cache['enabled'], cache_dir=saved_cache['dir'], max_bytes=saved_cache['max_bytes'])
+
+@pytest.fixture
+def stub_server(ollama_defaults):
+    servers = []
+
+    def start(default="OK"):
+        server = StubOllama(default)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
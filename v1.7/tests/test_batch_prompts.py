@@ -0,0 +1,54 @@
+import json
+
+import main
+
+SCENES = [{'Scene': f"S{idx}", 'Voiceover': f"Line {idx}", 'Description': f"Picture {idx}"} for idx in range(1, 4)]
+
+def batch_backend(ollama_defaults, reply):
+    prompts = []
+
+    def generate(prompt):
+        prompts.append(prompt)
+        if "JSON array with exactly" in prompt:
+            return json.dumps(reply)
+        name = prompt.split("- Scene: ", 1)[1].split("\n", 1)[0]
+        return json.dumps({'Name': name, 'Positive prompt': f"single {name}", 'Negative prompt': "n"})
+
+    main.register_backend('batch-test', generate)
+    main.configure_ollama(backend='batch-test')
+    return prompts
+
+def subjects(results):
+    # finalize_scene_prompt appends the style sentence; keep what the backend wrote
+    return [result['Positive prompt'].split(" Comic book-style")[0] for result in results]
+
+def test_zero_based_indexes_are_matched_by_name(ollama_defaults):
+    reply = [{'Index': idx, 'Name': scene['Scene'], 'Positive prompt': f"batch {scene['Scene']}"}
+             for idx, scene in enumerate(SCENES)]
+    prompts = batch_backend(ollama_defaults, reply)
+
+    results = main.generate_scene_prompt_batch(SCENES, [], "n")
+
+    assert [result['Name'] for result in results] == ["S1", "S2", "S3"]
+    assert subjects(results) == ["batch S1", "batch S2", "batch S3"]
+    assert len(prompts) == 1
+
+def test_index_disagreeing_with_name_falls_back_per_scene(ollama_defaults):
+    # S3's prompt claims index 1, and S2 has a prompt under an unknown name
+    reply = [{'Index': 1, 'Name': "S3", 'Positive prompt': "batch S3"},
+             {'Index': 2, 'Name': "Somewhere else", 'Positive prompt': "batch unknown"}]
+    prompts = batch_backend(ollama_defaults, reply)
+
+    results = main.generate_scene_prompt_batch(SCENES, [], "n")
+
+    assert subjects(results) == ["single S1", "single S2", "batch S3"]
+    assert len(prompts) == 3
+
+def test_nameless_objects_are_placed_by_index(ollama_defaults):
+    reply = [{'Index': 3, 'Positive prompt': "batch S3"}, {'Index': 1, 'Positive prompt': "batch S1"}]
+    prompts = batch_backend(ollama_defaults, reply)
+
+    results = main.generate_scene_prompt_batch(SCENES, [], "n")
+
+    assert subjects(results) == ["batch S1", "single S2", "batch S3"]
+    assert len(prompts) == 2
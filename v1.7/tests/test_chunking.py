@@ -0,0 +1,50 @@
+import json
+import re
+
+import pytest
+
+import main
+
+FOLLOW_UP = "A previous answer was incomplete"
+TEXT = "\n\n".join(f"{marker} " + "walks the ward in silence. " * 5 for marker in ("Alpha", "Beta", "Gamma"))
+
+@pytest.fixture
+def short_lists(ollama_defaults):
+    """Backend that answers every request with a single item, as a model does when a chunk
+    holds fewer characters or scenes than asked for. Every chunk finds the same character,
+    Ann; scenes are named after the chunk's marker word, follow-ups count up."""
+    prompts = []
+    saved = dict(main.chunk_settings)
+
+    def generate(prompt):
+        prompts.append(prompt)
+        marker = re.search(r"\b(Alpha|Beta|Gamma)\b", prompt).group(1)
+        if FOLLOW_UP in prompt:
+            marker = f"Extra {sum(FOLLOW_UP in seen for seen in prompts)}"
+        if "key characters" in prompt:
+            return json.dumps([{'Name': marker if FOLLOW_UP in prompt else "Ann", 'Age': "40"}])
+        return json.dumps([{'Scene': marker, 'Voiceover': f"{marker} line", 'Description': "ward"}])
+
+    main.register_backend('short-lists', generate)
+    main.configure_ollama(backend='short-lists')
+    main.configure_chunking(size=200, overlap=0)
+    yield prompts
+    main.configure_chunking(**saved)
+
+def test_chunks_are_not_followed_up_and_the_merge_tops_up_once(short_lists):
+    characters = main.identify_characters(TEXT, 3)
+
+    # Three chunk requests all find Ann, then one top-up for the two still missing
+    assert len(short_lists) == 4
+    assert sum(FOLLOW_UP in prompt for prompt in short_lists) == 1
+    assert [char['name'] for char in characters] == ["Ann", "Extra 1"]
+
+def test_scene_chunks_are_topped_up_in_a_single_round(short_lists):
+    scenes = main.suggest_scenes(TEXT, 6)
+
+    first_round = short_lists[:3]
+    assert not any(FOLLOW_UP in prompt for prompt in first_round)
+    # One top-up request per chunk that still owes scenes, and no further rounds
+    assert len(short_lists) == 6
+    assert len(scenes) == 6
+    assert len({scene['Scene'] for scene in scenes}) == 6
@@ -0,0 +1,45 @@
+import main
+
+def test_calls_go_to_the_least_loaded_endpoint(stub_server):
+    first, second = stub_server(), stub_server()
+    main.configure_ollama(endpoints=[first.url, second.url])
+
+    for idx in range(4):
+        assert main.run_ollama(f"prompt {idx}") == "OK"
+    assert len(first.requests) == 2
+    assert len(second.requests) == 2
+
+    # An endpoint with a request in flight is passed over
+    busy = main.acquire_endpoint(main.ollama_settings['model'])
+    idle = main.acquire_endpoint(main.ollama_settings['model'])
+    assert busy['host'] != idle['host']
+    main.release_endpoint(busy, True)
+    main.release_endpoint(idle, True)
+
+def test_failing_endpoint_leaves_the_rotation(stub_server):
+    broken, healthy = stub_server(), stub_server()
+    broken.default = 500
+    main.configure_ollama(endpoints=[broken.url, healthy.url], endpoint_max_failures=2,
+                          endpoint_cooldown=60.0, retries=1, cli_fallback=False)
+
+    for idx in range(6):
+        assert main.run_ollama(f"prompt {idx}") == "OK"
+
+    assert len(broken.requests) == 2
+    assert len(healthy.requests) == 6
+    stats = {endpoint['host']: endpoint for endpoint in main.endpoint_stats()}
+    assert stats[broken.url]['healthy'] is False
+    assert stats[broken.url]['errors'] == 2
+    assert stats[healthy.url]['healthy'] is True
+
+def test_stage_models_are_routed_to_the_endpoints_serving_them(stub_server):
+    small, large = stub_server("small"), stub_server("large")
+    main.configure_ollama(model='large-model', stage_models={'scene_prompts': 'small-model'},
+                          endpoints=[f"{small.url}=small-model", f"{large.url}=large-model"])
+
+    assert main.run_ollama("characters", stage='characters') == "large"
+    assert main.run_ollama("scene", stage='scene_prompts') == "small"
+    assert main.run_ollama("scenes", stage='scenes') == "large"
+
+    assert [request['body']['model'] for request in small.requests] == ['small-model']
+    assert [request['body']['model'] for request in large.requests] == ['large-model', 'large-model']
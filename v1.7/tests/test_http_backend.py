@@ -0,0 +1,52 @@
+import subprocess
+
+import pytest
+
+import main
+
+def test_requests_reuse_one_keep_alive_connection(stub_server):
+    server = stub_server()
+    main.configure_ollama(host=server.url, keep_alive='10m')
+
+    assert main.run_ollama("first") == "OK"
+    assert main.run_ollama("second") == "OK"
+
+    assert [request['body']['prompt'] for request in server.requests] == ["first", "second"]
+    assert all(request['body']['keep_alive'] == '10m' for request in server.requests)
+    assert all(request['path'] == '/api/generate' for request in server.requests)
+    # Both calls went over the same pooled connection
+    assert len({request['port'] for request in server.requests}) == 1
+
+def test_failed_requests_are_retried(stub_server):
+    server = stub_server("recovered")
+    server.replies = [500, 503]
+    main.configure_ollama(host=server.url, retries=2)
+
+    assert main.run_ollama("prompt") == "recovered"
+    assert len(server.requests) == 3
+
+def test_falls_back_to_cli_after_retries(stub_server, monkeypatch):
+    server = stub_server()
+    server.replies = [500] * 3
+    main.configure_ollama(host=server.url, retries=2, model='stub-model')
+    commands = []
+
+    def fake_run(command, **kwargs):
+        commands.append((command, kwargs['input']))
+        return subprocess.CompletedProcess(command, 0, stdout="from cli\n", stderr="")
+
+    monkeypatch.setattr(main.subprocess, 'run', fake_run)
+
+    assert main.run_ollama("prompt") == "from cli"
+    assert len(server.requests) == 3
+    assert commands == [(["ollama", "run", "stub-model"], "prompt")]
+
+def test_cli_fallback_can_be_disabled(stub_server, monkeypatch):
+    server = stub_server()
+    server.replies = [500]
+    main.configure_ollama(host=server.url, retries=0, cli_fallback=False)
+    monkeypatch.setattr(main.subprocess, 'run',
+                        lambda *args, **kwargs: pytest.fail("'ollama run' must not be called"))
+
+    assert main.run_ollama("prompt") == ""
+    assert len(server.requests) == 1
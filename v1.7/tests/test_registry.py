@@ -0,0 +1,62 @@
+import pytest
+
+import main
+
+def character(name, age="40"):
+    return main.normalize_character({'Name': name, 'Age': age, 'Description': f"{name} at {age}", 'Clothing': "coat"})
+
+@pytest.fixture
+def registry(tmp_path):
+    main.configure_registry(path=str(tmp_path / 'characters.sqlite3'))
+    yield
+    main.registry_settings['path'] = None
+    main.configure_registry()
+
+def lookup(name):
+    with main._registry_lock:
+        return main.registry_lookup(main.get_registry_connection(), name)
+
+def registered_id(name):
+    with main._registry_lock:
+        row = main.get_registry_connection().execute("SELECT id FROM characters WHERE name = ?", (name,)).fetchone()
+    return row[0]
+
+def test_lookup_order(registry):
+    main.register_characters('first', [character("Leon Gabor"), character("Clyde Benson")])
+    leon, clyde = registered_id("Leon Gabor"), registered_id("Clyde Benson")
+
+    # Exact alias, titles ignored
+    assert lookup("Dr. Leon Gabor") == leon
+    # A unique token-subset match sharing two words; the spelling is learned as an alias
+    resolved, matched = main.register_characters('second', [character("Clyde Benson Sr", "41")])
+    assert matched == 1
+    assert resolved[0]['name'] == "Clyde Benson"
+    with main._registry_lock:
+        row = main.get_registry_connection().execute(
+            "SELECT character_id FROM aliases WHERE alias = ?", ("clyde benson sr",)).fetchone()
+    assert row == (clyde,)
+    # Spelling similarity
+    assert lookup("Clyde Bensen") == clyde
+    assert lookup("Marta Hill") is None
+
+def test_one_word_name_does_not_claim_a_registered_full_name(registry):
+    main.register_characters('first', [character("John Smith", "40")])
+
+    resolved, matched = main.register_characters('second', [character("John", "9")])
+
+    assert matched == 0
+    assert resolved[0]['name'] == "John"
+    assert resolved[0]['age'] == "9"
+    assert lookup("John") == registered_id("John")
+    # Neither "john" nor the new one-word character becomes an alias counted in voiceovers
+    with main._registry_lock:
+        aliases = {alias for (alias,) in main.get_registry_connection().execute("SELECT alias FROM aliases")}
+    assert aliases == {"john smith"}
+    assert main.find_registered_characters("John ran. John hid. John slept.", 1) == []
+
+def test_placeholder_names_are_never_registered(registry):
+    resolved, matched = main.register_characters('first', [character("Unknown"), character("")])
+
+    assert matched == 0
+    assert len(resolved) == 2
+    assert lookup("Unknown") is None
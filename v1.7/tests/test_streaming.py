@@ -0,0 +1,51 @@
+import json
+
+import main
+
+def ndjson(*lines):
+    return b"".join(json.dumps(line).encode('utf-8') + b"\n" for line in lines)
+
+def test_stream_that_breaks_off_is_not_cached(stub_server, tmp_path, monkeypatch):
+    server = stub_server()
+    server.replies = [ndjson({'response': '[{"Name": "A"}, ', 'done': False}) + b"not json\n"]
+    main.configure_ollama(host=server.url)
+    main.configure_cache(enabled=True, cache_dir=str(tmp_path))
+    events = []
+    monkeypatch.setattr(main, 'metrics_events', events)
+
+    assert "".join(main.stream_ollama("prompt", stage='characters')) == '[{"Name": "A"}, '
+
+    assert main.get_cached_response("prompt", 'characters') is None
+    assert events[-1]['cut_off'] is True
+    assert events[-1]['ok'] is False
+
+def test_complete_stream_is_cached(stub_server, tmp_path):
+    server = stub_server()
+    server.replies = [ndjson({'response': '[{"Name": "A"}]', 'done': False}, {'response': '', 'done': True})]
+    main.configure_ollama(host=server.url)
+    main.configure_cache(enabled=True, cache_dir=str(tmp_path))
+
+    assert "".join(main.stream_ollama("prompt", stage='characters')) == '[{"Name": "A"}]'
+
+    assert main.get_cached_response("prompt", 'characters') == '[{"Name": "A"}]'
+
+def test_stream_stopped_after_every_wanted_object_is_cached(stub_server, tmp_path, monkeypatch):
+    scenes = [{'Scene': f"S{idx}", 'Voiceover': f"v{idx}", 'Description': f"d{idx}"} for idx in range(3)]
+    text = json.dumps(scenes)
+    server = stub_server()
+    # Sent in small pieces so the stream is still open when the second scene closes
+    server.replies = [ndjson(*[{'response': text[pos:pos + 8], 'done': False} for pos in range(0, len(text), 8)],
+                             {'response': '', 'done': True})]
+    main.configure_ollama(host=server.url)
+    main.configure_cache(enabled=True, cache_dir=str(tmp_path))
+    events = []
+    monkeypatch.setattr(main, 'metrics_events', events)
+
+    assert list(main.stream_scenes("voiceover", 2)) == scenes[:2]
+    assert events[-1]['cut_off'] is False
+    assert events[-1]['ok'] is True
+
+    # The second run is served from the cache
+    assert list(main.stream_scenes("voiceover", 2)) == scenes[:2]
+    assert len(server.requests) == 1
+    assert events[-1]['cache_hit'] is True